@@ -0,0 +1,157 @@
+import os
+import cv2
+import math
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from flask import jsonify
+from metrics import stage, ADMISSION_ACTIVE, ADMISSION_WAITING, ADMISSION_WAIT_SECONDS, ADMISSION_REJECTED
+
+# Cores this process may use; WEB_CONCURRENCY is the server's process count
+ADMISSION_CPUS = max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', '1')))
+
+# lane: (detections at once, requests allowed to wait, seconds one may wait).
+# Webcam frames go stale fast, so they queue briefly; videos run long, so
+# few run at once and a queued one waits longer. ADMISSION_<LANE>_SLOTS and
+# ADMISSION_<LANE>_QUEUE override the first two.
+ADMISSION_LANES = {
+    'webcam': (max(1, ADMISSION_CPUS // 2), ADMISSION_CPUS, 0.5),
+    'image': (max(1, ADMISSION_CPUS // 4), 2 * ADMISSION_CPUS, 10.0),
+    'video': (max(1, ADMISSION_CPUS // 4), 4, 30.0),
+}
+for lane, (slots, depth, timeout) in ADMISSION_LANES.items():
+    ADMISSION_LANES[lane] = (
+        int(os.environ.get(f'ADMISSION_{lane.upper()}_SLOTS', slots)),
+        int(os.environ.get(f'ADMISSION_{lane.upper()}_QUEUE', depth)),
+        timeout,
+    )
+
+# Worker processes or threads one /detect_video request may use: its
+# video slot's share of the cores, so every video slot running with full
+# workers still fits
+VIDEO_MAX_WORKERS = max(1, ADMISSION_CPUS // ADMISSION_LANES['video'][0])
+
+# OpenCV threads per detection. With every lane full, slots x threads
+# stays within the cores instead of each call spreading over all of them.
+OPENCV_THREADS = int(os.environ.get(
+    'OPENCV_THREADS', max(1, ADMISSION_CPUS // sum(slots for (slots, _, _) in ADMISSION_LANES.values()))
+))
+
+class Overloaded(Exception):
+    def __init__(self, lane, retry_after):
+        super().__init__(f"Too many {lane} requests, retry in {retry_after}s")
+        self.lane = lane
+        self.retry_after = retry_after
+
+class Lane:
+    # A fixed number of slots and a bounded line for them. Requests that
+    # find the line full, or wait past the timeout, are turned away at once
+    # rather than slowing down everyone already admitted.
+
+    def __init__(self, name, slots, depth, timeout):
+        self.name = name
+        self.slots = max(1, slots)
+        self.depth = depth
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        # Background work waiting for a slot; not part of the bounded line
+        self.background = 0
+        self.admitted = 0
+        self.rejected = 0
+        # Recent seconds per admitted request, for Retry-After
+        self.service_seconds = 1.0
+        self._ready = threading.Condition()
+
+    def retry_after(self):
+        # Roughly how long the line ahead takes to clear at the recent pace
+        return max(1, math.ceil(self.service_seconds * (self.waiting + 1) / self.slots))
+
+    def _reject(self, reason):
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(self.name, reason)
+        raise Overloaded(self.name, self.retry_after())
+
+    @contextmanager
+    def admit(self, wait=True):
+        # wait=False is for background work such as queued jobs: it never
+        # gives up and does not count against the line
+        start = time.perf_counter()
+        with stage('queue'), self._ready:
+            if self.active >= self.slots:
+                if not wait:
+                    self.background += 1
+                    try:
+                        self._ready.wait_for(lambda: self.active < self.slots)
+                    finally:
+                        self.background -= 1
+                else:
+                    if self.waiting >= self.depth:
+                        self._reject('queue_full')
+                    self.waiting += 1
+                    ADMISSION_WAITING.inc(self.name)
+                    try:
+                        ready = self._ready.wait_for(lambda: self.active < self.slots, self.timeout)
+                    finally:
+                        self.waiting -= 1
+                        ADMISSION_WAITING.dec(self.name)
+                    if not ready:
+                        self._reject('timeout')
+            self.active += 1
+            self.admitted += 1
+            ADMISSION_ACTIVE.inc(self.name)
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, self.name)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._ready:
+                self.active -= 1
+                self.service_seconds = 0.8 * self.service_seconds + 0.2 * (time.perf_counter() - start)
+                ADMISSION_ACTIVE.dec(self.name)
+                self._ready.notify()
+
+    def stats(self):
+        with self._ready:
+            return {
+                'slots': self.slots,
+                'queue_depth': self.depth,
+                'active': self.active,
+                'waiting': self.waiting,
+                'background_waiting': self.background,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'retry_after': self.retry_after(),
+            }
+
+lanes = {name: Lane(name, *config) for name, config in ADMISSION_LANES.items()}
+
+def admitted(lane):
+    # Runs the view inside a slot of `lane`
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with lanes[lane].admit():
+                return view(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def init_admission(app):
+    cv2.setNumThreads(OPENCV_THREADS)
+
+    @app.errorhandler(Overloaded)
+    def overloaded(e):
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    @app.route('/admission_stats')
+    def admission_stats():
+        return jsonify({
+            'cpus': ADMISSION_CPUS,
+            'opencv_threads': OPENCV_THREADS,
+            'lanes': {name: lane.stats() for name, lane in lanes.items()},
+        })
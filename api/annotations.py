@@ -0,0 +1,61 @@
+import io
+import csv
+import json
+import numpy as np
+from flask import Response
+from detection import BOX_CLASSES, BOX_DTYPE
+
+# Per-frame boxes for a whole video, one row per box; `frame` indexes the
+# source video and `cls` indexes BOX_CLASSES
+ANNOTATION_DTYPE = np.dtype([('frame', '<u4')] + BOX_DTYPE.descr)
+ANNOTATION_FORMATS = ('json', 'csv', 'npz')
+
+ANNOTATION_MIMETYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'npz': 'application/octet-stream',
+}
+
+def collect_annotations(frame_objects, frames=None):
+    # `frames` numbers each entry of frame_objects in the source video when
+    # only part of it was processed
+    if frames is None:
+        frames = np.arange(len(frame_objects))
+    counts = [len(objects) for objects in frame_objects]
+    annotations = np.empty(sum(counts), dtype=ANNOTATION_DTYPE)
+    annotations['frame'] = np.repeat(frames, counts)
+    if annotations.size:
+        boxes = np.concatenate(frame_objects)
+        for field in BOX_DTYPE.names:
+            annotations[field] = boxes[field]
+    return annotations
+
+def encode_annotations(annotations, info, fmt):
+    # `info` describes the source video (fps, frames, width, height)
+    if fmt == 'npz':
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, annotations=annotations, classes=np.array(BOX_CLASSES), **info)
+        return buffer.getvalue()
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(('frame', 'class', 'x', 'y', 'w', 'h'))
+        writer.writerows(
+            (frame, BOX_CLASSES[cls], x, y, w, h) for (frame, cls, x, y, w, h) in annotations.tolist()
+        )
+        return buffer.getvalue().encode()
+
+    # Rows rather than one object per box keeps the JSON close to the CSV size
+    return json.dumps({
+        **info,
+        'classes': BOX_CLASSES,
+        'columns': ANNOTATION_DTYPE.names,
+        'rows': annotations.tolist(),
+    }, separators=(',', ':')).encode()
+
+def annotations_response(annotations, info, fmt, filename):
+    response = Response(encode_annotations(annotations, info, fmt), mimetype=ANNOTATION_MIMETYPES[fmt])
+    if fmt != 'json':
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
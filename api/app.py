@@ -1,260 +1,583 @@
 import os
 import cv2
 import numpy as np
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from numpy.lib.recfunctions import structured_to_unstructured
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import uuid
-import base64
 from werkzeug.utils import secure_filename
 import time
+import struct
+import json
+from detection import (
+    BOX_CLASSES, FEATURE_CLASSES, parse_features, feature_key, decode_image, parse_flag, detect_objects, count_boxes,
+    summarize_objects, boxes_to_json, draw_objects, DETECTION_TILED, make_boxes, resolve_max_side
+)
+from cache import DetectionCache, content_key
+from metrics import init_metrics, stage, label, streamed
+from admission import init_admission, admitted, lanes
+from batch import open_batch, stream_batch
+from jobs import JobQueue, QueueFull
+from storage import StorageManager
+from video import (
+    VIDEO_WORKERS, VIDEO_PIPELINE, VIDEO_KEYFRAME_INTERVAL, VIDEO_MOTION_GATE, resolve_workers, count_frames,
+    process_video_parallel, process_video_pipelined, format_stage_timings,
+    process_video_tracked, summarize_tracks, MotionGate, process_video_gated, format_motion_stats,
+    video_properties, detect_video_frames, WHOLE_VIDEO, parse_segment, resolve_segment,
+    segment_frames, SegmentReader
+)
+from annotations import ANNOTATION_FORMATS, collect_annotations, annotations_response
+from webcam import WEBCAM_MOTION_GATE, WEBCAM_ROI_SEARCH, WebcamSessions, pacing_hints, RegionTracker, detect_session_frame
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
 app = Flask(__name__)
+init_metrics(app)
+init_admission(app)
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/uploads')
 PROCESSED_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/processed')
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/cache')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
-def load_cascade(cascade_name):
-    cascade_path = cv2.data.haarcascades + cascade_name
-    cascade = cv2.CascadeClassifier(cascade_path)
-    if cascade.empty():
-        print(f"Warning: Could not load {cascade_path}")
-    return cascade
+# Results keyed on upload content, so re-uploads skip the cascades
+cache = DetectionCache(CACHE_FOLDER)
 
-face_cascade = load_cascade('haarcascade_frontalface_default.xml')
-eye_cascade = load_cascade('haarcascade_eye.xml')
-pedestrian_cascade = load_cascade('haarcascade_fullbody.xml')
+def cache_url(path):
+    return f"/static/cache/{os.path.basename(path)}"
 
-try:
-    car_cascade = load_cascade('haarcascade_car.xml')
-except:
-    print("Warning: Car cascade file not found, using frontalface as fallback")
-    car_cascade = face_cascade 
+# Background video jobs for clips too long to process inside one request
+jobs = JobQueue()
+
+# Region search and motion gate state for webcam clients that send a
+# session id, and the viewer count their frames are paced by
+webcam_sessions = WebcamSessions()
+
+# Uploads and scratch outputs expire and are capped in total size; the
+# render cache bounds itself
+storage = StorageManager([UPLOAD_FOLDER, PROCESSED_FOLDER])
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/detect', methods=['POST'])
+@admitted('image')
 def detect():
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
     
     file = request.files['image']
     feature = request.form.get('feature', 'face')
+    label(feature)
+    max_side = request.form.get('max_side', type=int)
+    tiled = parse_flag(request.form.get('tiled'), DETECTION_TILED)
     
     if file.filename == '':
         return jsonify({'error': 'No image selected'}), 400
     
+    persist = parse_flag(request.form.get('persist'), True)
+    key, upload_size = content_key(
+        file.stream, feature=feature_key(feature), max_side=resolve_max_side(feature, max_side), tiled=tiled
+    )
+    cached = cache.get_result(key)
+
+    rendered_path = cache.get_render(key)
+    if cached is not None and rendered_path is not None:
+        cache.record_hit(upload_size + os.path.getsize(rendered_path))
+        return jsonify({
+            'image_url': cache_url(rendered_path),
+            'detections': cached['detections'],
+            'cached': True
+        })
+
+    if not persist:
+        # Decode straight from the upload buffer; the upload is never saved.
+        # Cached boxes are redrawn instead of running the cascades again.
+        try:
+            if cached is not None:
+                cache.record_hit(upload_size)
+            else:
+                cache.record_miss()
+
+            processed_image, detections, objects = process_image(
+                decode_image(file), feature, max_side, cached and cached['boxes'], tiled
+            )
+            if cached is None:
+                cache.put_result(key, {'boxes': objects, 'detections': detections})
+
+            processed_path = os.path.join(PROCESSED_FOLDER, f"processed_{uuid.uuid4()}.jpg")
+            with stage('encode'):
+                cv2.imwrite(processed_path, processed_image)
+
+            rendered_path = cache.render_path(key, '.jpg')
+            os.replace(processed_path, rendered_path)
+            cache.put_render(key, rendered_path)
+
+            return jsonify({
+                'image_url': cache_url(rendered_path),
+                'detections': detections,
+                'cached': cached is not None
+            })
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+    if cached is not None:
+        cache.record_hit(upload_size)
+    else:
+        cache.record_miss()
+
     filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(file_path)
+    file_path, unique_filename = save_upload(file, filename)
 
     try:
-        processed_image, detections = process_image(file_path, feature)
+        processed_image, detections, objects = process_image(
+            file_path, feature, max_side, cached and cached['boxes'], tiled
+        )
 
         processed_filename = f"processed_{unique_filename}"
         processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
-        cv2.imwrite(processed_path, processed_image)
+        with stage('encode'):
+            cv2.imwrite(processed_path, processed_image)
+
+        rendered_path = cache.render_path(key, os.path.splitext(filename)[1])
+        os.replace(processed_path, rendered_path)
+        cache.put_render(key, rendered_path)
+        if cached is None:
+            cache.put_result(key, {'boxes': objects, 'detections': detections})
 
         return jsonify({
-            'image_url': f"/static/processed/{processed_filename}",
-            'detections': detections
+            'image_url': cache_url(rendered_path),
+            'detections': detections,
+            'cached': cached is not None
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        storage.release(file_path)
+
+def read_video_request():
+    file = request.files['video']
+    options = {
+        'feature': request.form.get('feature', 'face'),
+        'max_side': request.form.get('max_side', type=int),
+        'workers': resolve_workers(request.form.get('workers', VIDEO_WORKERS, type=int)),
+        'pipeline': parse_flag(request.form.get('pipeline'), VIDEO_PIPELINE),
+        'keyframe_interval': request.form.get('keyframe_interval', VIDEO_KEYFRAME_INTERVAL, type=int),
+        'motion': parse_flag(request.form.get('motion'), VIDEO_MOTION_GATE),
+        # Resolved to frames once the clip is saved and its frame rate known
+        'segment': parse_segment(request.form),
+    }
+
+    label(options['feature'])
+
+    # Workers do not change the output, so they stay out of the key;
+    # pipelining adds stage timings to the response, so it goes in
+    key, upload_size = content_key(
+        file.stream, feature=feature_key(options['feature']),
+        max_side=resolve_max_side(options['feature'], options['max_side']),
+        pipeline=options['pipeline'], keyframe_interval=options['keyframe_interval'],
+        motion=options['motion'], segment=options['segment']
+    )
+    return file, options, key, upload_size
+
+def cached_video(key, upload_size, filename):
+    cached = cache.get_result(key)
+    rendered_path = cache.get_render(key)
+    if cached is None or rendered_path is None:
+        cache.record_miss()
+        return None
+
+    cache.record_hit(upload_size + os.path.getsize(rendered_path))
+    return {
+        'video_url': cache_url(rendered_path),
+        'original_filename': filename,
+        'detections': cached['detections'],
+        'cached': True,
+        **cached['stats']
+    }
+
+def save_upload(file, filename):
+    # The upload is leased until the caller releases it, so the janitor
+    # leaves it alone however long processing takes
+    unique_filename = f"{uuid.uuid4()}_{filename}"
+    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
+    storage.acquire(file_path)
+    with stage('save'):
+        file.save(file_path)
+    return file_path, unique_filename
+
+def render_video(file_path, unique_filename, filename, key, options, progress=None):
+    processed_filename = f"processed_{unique_filename}"
+    processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
+
+    stats = {}
+    storage.acquire(processed_path)
+    try:
+        processed_video, detections = process_video(
+            file_path, processed_path, options['feature'], options['workers'], options['pipeline'],
+            options['keyframe_interval'], options['max_side'], stats, progress, options['motion'],
+            resolve_segment(file_path, options['segment'])
+        )
+
+        rendered_path = cache.render_path(key, os.path.splitext(filename)[1])
+        os.replace(processed_path, rendered_path)
+    finally:
+        storage.release(processed_path)
+    cache.put_render(key, rendered_path)
+    # Hits answer with the same shape, stats included
+    cache.put_result(key, {'detections': detections, 'stats': stats})
+
+    return {
+        'video_url': cache_url(rendered_path),
+        'original_filename': filename,
+        'detections': detections,
+        'cached': False,
+        **stats
+    }
 
 @app.route('/detect_video', methods=['POST'])
+@admitted('video')
 def detect_video():
     if 'video' not in request.files:
         return jsonify({'error': 'No video provided'}), 400
     
-    file = request.files['video']
-    feature = request.form.get('feature', 'face')
+    try:
+        file, options, key, upload_size = read_video_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     if file.filename == '':
         return jsonify({'error': 'No video selected'}), 400
 
     filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(file_path)
+
+    result = cached_video(key, upload_size, filename)
+    if result is not None:
+        return jsonify(result)
+
+    file_path, unique_filename = save_upload(file, filename)
     
     try:
-        processed_filename = f"processed_{unique_filename}"
-        processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
+        return jsonify(render_video(file_path, unique_filename, filename, key, options))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        storage.release(file_path)
 
-        processed_video, detections = process_video(file_path, processed_path, feature)
+def render_video_job(file_path, *args, progress=None):
+    # Queued jobs hold the upload lease from submission until they finish,
+    # and share the video lane with requests, waiting as long as it takes
+    try:
+        with lanes['video'].admit(wait=False):
+            return render_video(file_path, *args, progress=progress)
+    finally:
+        storage.release(file_path)
 
-        return jsonify({
-            'video_url': f"/static/processed/{processed_filename}",
-            'original_filename': filename,
-            'detections': detections
-        })
+@app.route('/annotate_video', methods=['POST'])
+@admitted('video')
+def annotate_video():
+    # Per-frame boxes only: nothing is drawn or encoded, and the result
+    # comes back as JSON rows, CSV or a NumPy .npz archive
+    if 'video' not in request.files:
+        return jsonify({'error': 'No video provided'}), 400
+
+    file = request.files['video']
+    feature = request.form.get('feature', 'face')
+    label(feature)
+    max_side = request.form.get('max_side', type=int)
+    workers = resolve_workers(request.form.get('workers', VIDEO_WORKERS, type=int))
+    fmt = request.form.get('format', 'json').lower()
+    if fmt not in ANNOTATION_FORMATS:
+        return jsonify({'error': f"Unknown format '{fmt}', expected one of {', '.join(ANNOTATION_FORMATS)}"}), 400
+    try:
+        segment_options = parse_segment(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if file.filename == '':
+        return jsonify({'error': 'No video selected'}), 400
+
+    filename = secure_filename(file.filename)
+    export_name = f"{os.path.splitext(filename)[0]}_annotations"
+
+    # The format only changes the encoding, so one cached result serves all of them
+    key, upload_size = content_key(
+        file.stream, feature=feature_key(feature), max_side=resolve_max_side(feature, max_side), annotations=True,
+        segment=segment_options
+    )
+    cached = cache.get_result(key)
+    if cached is not None:
+        cache.record_hit(upload_size)
+        return annotations_response(cached['annotations'], cached['info'], fmt, export_name)
+    cache.record_miss()
+
+    file_path, _ = save_upload(file, filename)
+
+    try:
+        segment = resolve_segment(file_path, segment_options)
+        info = {'feature': feature, **video_properties(file_path), 'start_frame': segment[0], 'stride': segment[2]}
+        frame_objects = detect_video_frames(file_path, feature, workers, max_side, segment=segment)
+        info['frames'] = len(frame_objects)
+        annotations = collect_annotations(frame_objects, segment_frames(segment, len(frame_objects)))
+        cache.put_result(key, {'annotations': annotations, 'info': info})
+
+        return annotations_response(annotations, info, fmt, export_name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        storage.release(file_path)
+
+@app.route('/jobs/video', methods=['POST'])
+def submit_video_job():
+    # Same form as /detect_video, but answers with a job id straight away
+    # and leaves the clip to the background workers
+    if 'video' not in request.files:
+        return jsonify({'error': 'No video provided'}), 400
+
+    try:
+        file, options, key, upload_size = read_video_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if file.filename == '':
+        return jsonify({'error': 'No video selected'}), 400
+
+    filename = secure_filename(file.filename)
+
+    result = cached_video(key, upload_size, filename)
+    if result is not None:
+        job = jobs.completed(result)
+    else:
+        file_path, unique_filename = save_upload(file, filename)
+        try:
+            segment = resolve_segment(file_path, options['segment'])
+            job = jobs.submit(
+                render_video_job, file_path, unique_filename, filename, key, options,
+                total_frames=count_frames(file_path, segment)
+            )
+        except Exception as e:
+            # Nothing will pick the upload up, whatever went wrong
+            storage.release(file_path)
+            os.remove(file_path)
+            status = 503 if isinstance(e, QueueFull) else 400 if isinstance(e, ValueError) else 500
+            return jsonify({'error': str(e)}), status
+
+    return jsonify({**job.to_json(), 'status_url': f"/jobs/{job.id}"}), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    data = job.to_json()
+    if job.status == 'done':
+        data['result_url'] = f"/jobs/{job.id}/result"
+    return jsonify(data)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.status == 'failed':
+        return jsonify({'error': job.error}), 500
+    if job.status != 'done':
+        return jsonify({'error': f"Job is {job.status}", **job.to_json()}), 409
+    return jsonify(job.result)
+
+@app.route('/jobs')
+def job_stats():
+    return jsonify(jobs.stats())
+
+@app.route('/detect_batch', methods=['POST'])
+def detect_batch():
+    # Images are read from the body as detection keeps up and reported one
+    # JSON line each as they finish, so batch size does not bound memory
+    try:
+        items, fields = open_batch(request)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return Response(stream_with_context(streamed(stream_batch(items, fields, cache))), mimetype='application/x-ndjson')
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(cache.stats())
+
+@app.route('/storage_stats')
+def storage_stats():
+    return jsonify(storage.stats())
+
+# Feature codes for frames sent over the webcam socket; replies use the
+# BOX_CLASSES codes
+SOCKET_FEATURES = ['face', 'pedestrian', 'vehicle', 'face,pedestrian,vehicle']
+# Seconds between pacing messages on a webcam socket
+SOCKET_PACING_INTERVAL = 1.0
 
 @app.route('/detect_webcam', methods=['POST'])
+@admitted('webcam')
 def detect_webcam():
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
     
+    start = time.perf_counter()
     file = request.files['image']
     feature = request.form.get('feature', 'face')
+    label(feature)
+    max_side = request.form.get('max_side', type=int)
+    motion = parse_flag(request.form.get('motion'), WEBCAM_MOTION_GATE)
+    # Sessions are also how viewers are counted for pacing
+    session = webcam_sessions.get(request.form.get('session'))
     
     if file.filename == '':
         return jsonify({'error': 'No image selected'}), 400
 
-    filename = "webcam_frame.jpg"
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(file_path)
-
     try:
+        img = decode_image(file)
+        stats = {}
+        if session is not None and (motion or WEBCAM_ROI_SEARCH):
+            objects, stats = detect_session_frame(session, img, feature, max_side, motion)
+        else:
+            objects = detect_objects(img, feature, max_side=max_side)
+        summary = summarize_objects(objects, feature)
 
-        img = cv2.imread(file_path)
-        
-        boxes = []
-        colors = []
-        detections = []
-        
-        if feature == 'face':
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-            
-            face_count = 0
-            eye_count = 0
-            
-            for (x, y, w, h) in faces:
-                boxes.append({'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)})
-                colors.append('rgba(255, 0, 255, 0.8)')
-                face_count += 1
-
-                roi_gray = gray[y:y+h, x:x+w]
-                eyes = eye_cascade.detectMultiScale(roi_gray)
-                
-                for (ex, ey, ew, eh) in eyes:
-                    boxes.append({'x': int(x+ex), 'y': int(y+ey), 'width': int(ew), 'height': int(eh)})
-                    colors.append('rgba(255, 255, 0, 0.8)')
-                    eye_count += 1
-            
-            if face_count > 0 or eye_count > 0:
-                detections.append(f"Detected {face_count} face(s) and {eye_count} eye(s).")
-            else:
-                detections.append("No faces or eyes detected.")
-                
-        elif feature == 'pedestrian':
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-            pedestrians = pedestrian_cascade.detectMultiScale(gray, 1.1, 3)
-            
-            for (x, y, w, h) in pedestrians:
-                boxes.append({'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)})
-                colors.append('rgba(0, 255, 255, 0.8)')
-            
-            if len(pedestrians) > 0:
-                detections.append(f"Detected {len(pedestrians)} pedestrian(s).")
-            else:
-                detections.append("No pedestrians detected.")
-                
-        elif feature == 'vehicle':
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            vehicles = car_cascade.detectMultiScale(gray, 1.1, 3)
-            
-            for (x, y, w, h) in vehicles:
-                boxes.append({'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)})
-                colors.append('rgba(0, 255, 0, 0.8)')
-            
-            if len(vehicles) > 0:
-                detections.append(f"Detected {len(vehicles)} vehicle(s).")
-            else:
-                detections.append("No vehicles detected.")
-        
-        os.remove(file_path)
-        
         return jsonify({
-            'boxes': boxes,
-            'colors': colors,
-            'detections': detections
+            **boxes_to_json(objects),
+            'detections': [summary] if summary else [],
+            'pacing': pacing_hints(lanes['webcam'], time.perf_counter() - start, webcam_sessions.viewers()),
+            **stats
         })
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
         return jsonify({'error': str(e)}), 500
 
-def process_image(image_path, feature):
-    img = cv2.imread(image_path)
-    
-    detections = []
-    
-    if feature == 'face':
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+# Socket replies are <uint32 seq> followed by int16 (class, x, y, w, h) rows,
+# so the browser can read them as an Int16Array without any parsing
+def encode_socket_boxes(seq, boxes):
+    return struct.pack('<I', seq) + structured_to_unstructured(boxes, dtype='<i2').tobytes()
 
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        
-        face_count = 0
-        eye_count = 0
-        
-        for (x, y, w, h) in faces:
-            cv2.rectangle(img, (x, y), (x+w, y+h), (255, 0, 255), 2)
-            face_count += 1
-            
-            roi_gray = gray[y:y+h, x:x+w]
-            roi_color = img[y:y+h, x:x+w]
-            eyes = eye_cascade.detectMultiScale(roi_gray)
-            
-            for (ex, ey, ew, eh) in eyes:
-                cv2.rectangle(roi_color, (ex, ey), (ex+ew, ey+eh), (255, 255, 0), 2)
-                eye_count += 1
-        
-        if face_count > 0 or eye_count > 0:
-            detections.append(f"Detected {face_count} face(s) and {eye_count} eye(s).")
-        else:
-            detections.append("No faces or eyes detected.")
-            
-    elif feature == 'pedestrian':
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        pedestrians = pedestrian_cascade.detectMultiScale(gray, 1.1, 3)
-        
-        for (x, y, w, h) in pedestrians:
-            cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 255), 2)
-        
-        if len(pedestrians) > 0:
-            detections.append(f"Detected {len(pedestrians)} pedestrian(s).")
-        else:
-            detections.append("No pedestrians detected.")
-            
-    elif feature == 'vehicle':
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        vehicles = car_cascade.detectMultiScale(gray, 1.1, 3)
-        
-        for (x, y, w, h) in vehicles:
-            cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 0), 2)
-        
-        if len(vehicles) > 0:
-            detections.append(f"Detected {len(vehicles)} vehicle(s).")
-        else:
-            detections.append("No vehicles detected.")
-    
-    return img, detections
+# Frames that get no boxes are answered with a JSON text message instead,
+# so the browser can tell them apart; retry_after says to hold off
+def encode_socket_error(seq, e):
+    return json.dumps({'seq': seq, 'error': str(e), 'retry_after': getattr(e, 'retry_after', None)})
 
-def process_video(video_path, output_path, feature):
-    cap = cv2.VideoCapture(video_path)
-    
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/ws/webcam')
+    def webcam_socket(ws):
+        # Each message is <uint32 seq><uint8 feature code><JPEG bytes>. Frames
+        # are answered in order; the client keeps a few in flight so the next
+        # one is already buffered while the current one is being detected.
+        # The connection doubles as the session for region search and the
+        # motion gate, and counts as a viewer for pacing.
+        # Every frame takes a slot in the webcam lane like an HTTP frame.
+        # About once a second a JSON text message carries the same pacing
+        # hints /detect_webcam returns, so socket clients slow down too
+        # when several viewers share the lane.
+        search = MotionGate() if WEBCAM_MOTION_GATE else RegionTracker() if WEBCAM_ROI_SEARCH else None
+        last_pacing = None
+        with webcam_sessions.connected():
+            while True:
+                message = ws.receive()
+                if not isinstance(message, (bytes, bytearray)) or len(message) < 5:
+                    continue
+
+                seq, feature_code = struct.unpack_from('<IB', message)
+                img = cv2.imdecode(np.frombuffer(message, np.uint8, offset=5), cv2.IMREAD_COLOR)
+                if img is None or feature_code >= len(SOCKET_FEATURES):
+                    ws.send(encode_socket_boxes(seq, make_boxes([])))
+                    continue
+
+                try:
+                    with lanes['webcam'].admit():
+                        start = time.perf_counter()
+                        if search is not None:
+                            objects = search.detect(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), SOCKET_FEATURES[feature_code])
+                        else:
+                            objects = detect_objects(img, SOCKET_FEATURES[feature_code])
+                except Exception as e:
+                    # One bad frame must not end the stream
+                    ws.send(encode_socket_error(seq, e))
+                    continue
+                ws.send(encode_socket_boxes(seq, objects))
+
+                now = time.perf_counter()
+                if last_pacing is None or now - last_pacing >= SOCKET_PACING_INTERVAL:
+                    last_pacing = now
+                    hints = pacing_hints(lanes['webcam'], now - start, webcam_sessions.viewers())
+                    ws.send(json.dumps({'pacing': hints}))
+
+def process_image(image, feature, max_side=None, objects=None, tiled=False):
+    if isinstance(image, str):
+        with stage('decode'):
+            img = cv2.imread(image)
+    else:
+        img = image
+
+    if objects is None:
+        objects = detect_objects(img, feature, max_side=max_side, tiled=tiled)
+    draw_objects(img, objects)
+
+    summary = summarize_objects(objects, feature)
+    return img, [summary] if summary else [], objects
+
+def process_video(video_path, output_path, feature, workers=1, pipeline=False,
+                  keyframe_interval=0, max_side=None, stats=None, progress=None, motion=False,
+                  segment=WHOLE_VIDEO):
+    # Every path reads only the segment's frames, and the output video and
+    # counts cover just those
+    if stats is not None and segment != WHOLE_VIDEO:
+        stats['segment'] = dict(zip(('start_frame', 'end_frame', 'stride'), segment))
+
+    if keyframe_interval > 0:
+        frame_objects, tracking = process_video_tracked(
+            video_path, output_path, feature, keyframe_interval, max_side, progress, segment
+        )
+        if stats is not None:
+            stats['tracking'] = tracking
+        return output_path, summarize_tracks(feature, len(frame_objects), tracking)
+
+    if motion:
+        frame_objects, motion_stats = process_video_gated(video_path, output_path, feature, max_side, progress, segment)
+        if stats is not None:
+            stats['motion'] = motion_stats
+    elif pipeline:
+        frame_objects, timings = process_video_pipelined(video_path, output_path, feature, workers, max_side, progress, segment)
+        if stats is not None:
+            stats['stage_timings'] = timings
+    elif workers > 1:
+        frame_objects = process_video_parallel(video_path, output_path, feature, workers, max_side, progress, segment)
+
+    if motion or pipeline or workers > 1:
+        detection_counts = dict.fromkeys(BOX_CLASSES, 0)
+        for objects in frame_objects:
+            for label, count in count_boxes(objects).items():
+                detection_counts[label] += count
+
+        detections = summarize_video(feature, len(frame_objects), detection_counts)
+        if motion:
+            detections.append(format_motion_stats(motion_stats))
+        elif pipeline:
+            detections.append(format_stage_timings(timings, len(frame_objects), workers))
+
+        return output_path, detections
+
+    cap = SegmentReader(video_path, segment)
     
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+    out = cv2.VideoWriter(output_path, fourcc, cap.fps, (cap.width, cap.height))
 
     frame_count = 0
-    detection_counts = {'face': 0, 'eye': 0, 'pedestrian': 0, 'vehicle': 0}
+    detection_counts = dict.fromkeys(BOX_CLASSES, 0)
     
     while cap.isOpened():
         ret, frame = cap.read()
@@ -262,60 +585,30 @@ def process_video(video_path, output_path, feature):
             break
         
         frame_count += 1
-        
-        if feature == 'face':
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
-            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-            
-            for (x, y, w, h) in faces:
-                cv2.rectangle(frame, (x, y), (x+w, y+h), (255, 0, 255), 2)
-                detection_counts['face'] += 1
-                
-                roi_gray = gray[y:y+h, x:x+w]
-                roi_color = frame[y:y+h, x:x+w]
-                eyes = eye_cascade.detectMultiScale(roi_gray)
-                
-                for (ex, ey, ew, eh) in eyes:
-                    cv2.rectangle(roi_color, (ex, ey), (ex+ew, ey+eh), (255, 255, 0), 2)
-                    detection_counts['eye'] += 1
-                
-        elif feature == 'pedestrian':
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
-            pedestrians = pedestrian_cascade.detectMultiScale(gray, 1.1, 3)
-            
-            for (x, y, w, h) in pedestrians:
-                cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 255), 2)
-                detection_counts['pedestrian'] += 1
-                
-        elif feature == 'vehicle':
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            vehicles = car_cascade.detectMultiScale(gray, 1.1, 3)
-            
-            for (x, y, w, h) in vehicles:
-                cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                detection_counts['vehicle'] += 1
-
-        out.write(frame)
+
+        objects = detect_objects(frame, feature, max_side=max_side)
+        for label, count in count_boxes(objects).items():
+            detection_counts[label] += count
+
+        draw_objects(frame, objects)
+        with stage('encode'):
+            out.write(frame)
+        if progress is not None:
+            progress(frame_count)
 
     cap.release()
     out.release()
 
-    detections = []
-    if feature == 'face':
-        detections.append(f"Processed {frame_count} frames.")
-        detections.append(f"Detected {detection_counts['face']} face instances.")
-        detections.append(f"Detected {detection_counts['eye']} eye instances.")
-    elif feature == 'pedestrian':
-        detections.append(f"Processed {frame_count} frames.")
-        detections.append(f"Detected {detection_counts['pedestrian']} pedestrian instances.")
-    elif feature == 'vehicle':
-        detections.append(f"Processed {frame_count} frames.")
-        detections.append(f"Detected {detection_counts['vehicle']} vehicle instances.")
+    return output_path, summarize_video(feature, frame_count, detection_counts)
+
+def summarize_video(feature, frame_count, detection_counts):
+    features = parse_features(feature)
+    detections = [f"Processed {frame_count} frames."] if features else []
+    for name in features:
+        for label in FEATURE_CLASSES[name]:
+            detections.append(f"Detected {detection_counts[label]} {label} instances.")
     
-    return output_path, detections
+    return detections
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
@@ -0,0 +1,212 @@
+import io
+import os
+import json
+import zlib
+import zipfile
+import tempfile
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+from detection import feature_key, detect_objects, summarize_objects, boxes_to_json, resolve_max_side
+from cache import content_key
+from metrics import stage, label, bind
+from admission import ADMISSION_LANES, lanes
+
+# Threads work across cores here: OpenCV drops the GIL while decoding and
+# detecting, and the detector engine hands each thread its own cascades.
+# Each image still takes an image lane slot, shared with /detect and every
+# other batch, so the default is that lane's slot count.
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(ADMISSION_LANES['image'][0])))
+# Images read from the upload but not yet reported back. This, not the
+# batch size, is what bounds memory.
+BATCH_MAX_IN_FLIGHT = int(os.environ.get('BATCH_MAX_IN_FLIGHT', str(BATCH_WORKERS * 2)))
+BATCH_MAX_IMAGE_BYTES = int(os.environ.get('BATCH_MAX_IMAGE_BYTES', str(32 * 1024 * 1024)))
+
+STREAM_CHUNK_SIZE = 64 * 1024
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+def iter_zip_images(fileobj):
+    # Members are read one at a time, so the archive never sits in memory
+    with zipfile.ZipFile(fileobj) as archive:
+        for member in archive.infolist():
+            if member.is_dir() or not member.filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            if member.file_size > BATCH_MAX_IMAGE_BYTES:
+                yield member.filename, None
+                continue
+            yield member.filename, archive.read(member)
+
+def spool_stream(stream):
+    spool = tempfile.TemporaryFile()
+    for chunk in iter(lambda: stream.read(STREAM_CHUNK_SIZE), b''):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def iter_multipart_images(stream, boundary, fields):
+    # Walks the request body part by part instead of letting Flask parse
+    # every file up front. Image parts are yielded as soon as they end, and
+    # an 'archive' part is spooled to a temporary file and expanded. Plain
+    # form fields land in `fields` as they are read, so parameters sent
+    # before the files apply to them.
+    decoder = MultipartDecoder(boundary.encode())
+    part = None
+    chunks = []
+    size = 0
+    spool = None
+    finished = False
+
+    while True:
+        event = decoder.next_event()
+
+        if isinstance(event, NeedData):
+            if finished:
+                raise ValueError('Unexpected end of multipart body')
+            chunk = stream.read(STREAM_CHUNK_SIZE)
+            finished = not chunk
+            decoder.receive_data(chunk or None)
+
+        elif isinstance(event, (Field, File)):
+            part = event
+            chunks = []
+            size = 0
+            if isinstance(part, File) and part.name == 'archive':
+                spool = tempfile.TemporaryFile()
+
+        elif isinstance(event, Data):
+            if spool is not None:
+                spool.write(event.data)
+            else:
+                size += len(event.data)
+                if size <= BATCH_MAX_IMAGE_BYTES:
+                    chunks.append(event.data)
+
+            if event.more_data:
+                continue
+
+            if spool is not None:
+                spool.seek(0)
+                with spool:
+                    yield from iter_zip_images(spool)
+                spool = None
+            elif isinstance(part, File):
+                yield part.filename, b''.join(chunks) if size <= BATCH_MAX_IMAGE_BYTES else None
+            else:
+                fields[part.name] = b''.join(chunks).decode('utf-8', 'replace')
+
+        elif isinstance(event, Epilogue):
+            return
+
+# Ways an upload can turn out broken once the response is under way
+STREAM_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, ValueError)
+
+def parse_max_side(value):
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"max_side must be an integer, got '{value}'")
+
+def open_batch(request):
+    # Parameters come from the query string, or from form fields placed
+    # before the files in a multipart body. Query parameters are checked
+    # here, while a 400 can still be sent.
+    fields = request.args.to_dict()
+    parse_max_side(fields.get('max_side'))
+
+    if request.mimetype in ('application/zip', 'application/x-zip-compressed'):
+        def items():
+            with spool_stream(request.stream) as spool:
+                yield from iter_zip_images(spool)
+        return items(), fields
+
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        raise ValueError('Send images as multipart/form-data or a zip archive')
+
+    return iter_multipart_images(request.stream, boundary, fields), fields
+
+def detect_batch_image(index, name, data, feature, max_side, cache):
+    if data is None:
+        return {'index': index, 'name': name, 'error': 'Image too large'}
+
+    try:
+        key, _ = content_key(io.BytesIO(data), feature=feature_key(feature), max_side=resolve_max_side(feature, max_side))
+        cached = cache.get_result(key) if cache is not None else None
+
+        if cached is not None:
+            cache.record_hit(len(data))
+            objects = cached['boxes']
+        else:
+            # The 200 is already sent, so an image waits for a slot rather
+            # than being turned away
+            with lanes['image'].admit(wait=False):
+                with stage('decode'):
+                    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+                if img is None:
+                    raise ValueError('Could not decode image')
+                objects = detect_objects(img, feature, max_side=max_side)
+
+            if cache is not None:
+                cache.record_miss()
+                summary = summarize_objects(objects, feature)
+                cache.put_result(key, {'boxes': objects, 'detections': [summary] if summary else []})
+
+        summary = summarize_objects(objects, feature)
+        return {
+            'index': index,
+            'name': name,
+            **boxes_to_json(objects),
+            'detections': [summary] if summary else [],
+            'cached': cached is not None
+        }
+    except Exception as e:
+        return {'index': index, 'name': name, 'error': str(e)}
+
+def stream_batch(items, fields, cache=None, workers=BATCH_WORKERS, max_in_flight=BATCH_MAX_IN_FLIGHT):
+    # Yields one JSON line per image as soon as it finishes, in completion
+    # order, followed by a summary line. Reading more of the upload waits
+    # whenever max_in_flight images are outstanding. By the time the body
+    # turns out to be broken the 200 has been sent, so that is reported as
+    # an error line and the images already read are still finished.
+    count = 0
+    errors = 0
+    pending = set()
+
+    def finished(futures):
+        nonlocal errors
+        for future in futures:
+            result = future.result()
+            errors += 'error' in result
+            yield json.dumps(result) + '\n'
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for name, data in items:
+                feature = fields.get('feature', 'face')
+                label(feature)
+                try:
+                    # A form field may set it after the query was checked
+                    max_side = parse_max_side(fields.get('max_side'))
+                except ValueError as e:
+                    errors += 1
+                    yield json.dumps({'index': count, 'name': name, 'error': str(e)}) + '\n'
+                    count += 1
+                    continue
+                pending.add(pool.submit(bind(detect_batch_image), count, name, data, feature, max_side, cache))
+                count += 1
+
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from finished(done)
+        except STREAM_ERRORS as e:
+            errors += 1
+            yield json.dumps({'error': f"Could not read the upload: {e}"}) + '\n'
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from finished(done)
+
+    yield json.dumps({'done': True, 'count': count, 'errors': errors}) + '\n'
@@ -0,0 +1,132 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from detection import EYE_SEARCH
+
+# Box results kept in memory, by entry count
+RESULT_CACHE_ENTRIES = int(os.environ.get('RESULT_CACHE_ENTRIES', '256'))
+# Rendered images and videos kept on disk, by total size
+RENDER_CACHE_BYTES = int(os.environ.get('RENDER_CACHE_BYTES', str(512 * 1024 * 1024)))
+
+# Bump when detection output changes so stale entries stop matching
+CACHE_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def content_key(stream, **params):
+    # Hash of the uploaded bytes plus everything that changes the result.
+    # The stream is rewound afterwards so it can still be saved on a miss.
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    size = stream.tell()
+    stream.seek(0)
+
+    digest.update(json.dumps({'version': CACHE_VERSION, 'eye_search': EYE_SEARCH, **params}, sort_keys=True).encode())
+    return digest.hexdigest(), size
+
+class DetectionCache:
+    def __init__(self, folder, max_entries=RESULT_CACHE_ENTRIES, max_bytes=RENDER_CACHE_BYTES):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.results = OrderedDict()
+        self.renders = OrderedDict()
+        self.render_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        # Renders outlive the process; pick them back up oldest first so
+        # eviction order survives a restart
+        entries = [entry for entry in os.scandir(folder) if entry.is_file()]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            key = os.path.splitext(entry.name)[0]
+            self.renders[key] = (entry.path, entry.stat().st_size)
+            self.render_bytes += entry.stat().st_size
+        self._evict_renders()
+
+    def render_path(self, key, ext):
+        return os.path.join(self.folder, f"{key}{ext.lower()}")
+
+    def get_result(self, key):
+        with self._lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+            return result
+
+    def put_result(self, key, result):
+        with self._lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+    def get_render(self, key):
+        with self._lock:
+            entry = self.renders.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry[0]):
+                del self.renders[key]
+                self.render_bytes -= entry[1]
+                return None
+            self.renders.move_to_end(key)
+            return entry[0]
+
+    def put_render(self, key, path):
+        size = os.path.getsize(path)
+        with self._lock:
+            previous = self.renders.pop(key, None)
+            if previous is not None:
+                self.render_bytes -= previous[1]
+                # Same content rendered under another extension
+                if previous[0] != path and os.path.exists(previous[0]):
+                    os.remove(previous[0])
+            self.renders[key] = (path, size)
+            self.render_bytes += size
+            self._evict_renders(keep=key)
+
+    def _evict_renders(self, keep=None):
+        while self.render_bytes > self.max_bytes and len(self.renders) > (1 if keep else 0):
+            key, (path, size) = next(iter(self.renders.items()))
+            if key == keep:
+                self.renders.move_to_end(key)
+                continue
+            del self.renders[key]
+            self.render_bytes -= size
+            self.evictions += 1
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record_hit(self, saved_bytes):
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += saved_bytes
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'evictions': self.evictions,
+                'result_entries': len(self.results),
+                'render_entries': len(self.renders),
+                'render_bytes': self.render_bytes,
+            }
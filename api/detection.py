@@ -0,0 +1,454 @@
+import os
+import cv2
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from metrics import stage, CASCADE_LOAD_SECONDS
+from admission import ADMISSION_CPUS
+
+class CascadeUnavailable(RuntimeError):
+    pass
+
+def load_cascade(cascade_name):
+    cascade_path = cv2.data.haarcascades + cascade_name
+    cascade = cv2.CascadeClassifier(cascade_path)
+    if cascade.empty():
+        reason = 'is not a valid cascade' if os.path.exists(cascade_path) else 'does not exist'
+        raise CascadeUnavailable(f"Cascade {cascade_path} {reason}")
+    return cascade
+
+def decode_image(file):
+    data = np.frombuffer(file.read(), np.uint8)
+    with stage('decode'):
+        img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError('Could not decode image')
+    return img
+
+def parse_flag(value, default=False):
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+CASCADE_FILES = {
+    'face': 'haarcascade_frontalface_default.xml',
+    'eye': 'haarcascade_eye.xml',
+    'pedestrian': 'haarcascade_fullbody.xml',
+    'vehicle': 'haarcascade_car.xml',
+}
+
+# Longest image side the cascades search, per feature. Larger inputs are
+# downscaled once before detection and the boxes mapped back; 0 searches
+# at full resolution. DETECTION_MAX_SIDE overrides all features at once.
+# 1280 loses no boxes on the sample uploads for any feature; lower caps
+# are faster but opt-in.
+DETECTION_MAX_SIDE = {
+    'face': 1280,
+    'pedestrian': 1280,
+    'vehicle': 1280,
+}
+if os.environ.get('DETECTION_MAX_SIDE'):
+    DETECTION_MAX_SIDE = dict.fromkeys(DETECTION_MAX_SIDE, int(os.environ['DETECTION_MAX_SIDE']))
+
+# Search for eyes only where they can be: the upper part of each face box,
+# at sizes relative to the face, on a coarser pyramid. EYE_SEARCH=full
+# scans the whole face ROI at every scale as before.
+EYE_SEARCH = os.environ.get('EYE_SEARCH', 'constrained')
+# Eyes sit above this fraction of the face height
+EYE_REGION_BOTTOM = 0.6
+# Eye box width bounds, as fractions of the face width
+EYE_MIN_WIDTH = 0.15
+EYE_MAX_WIDTH = 0.45
+EYE_SCALE_FACTOR = 1.15
+
+# Split the search over large stills into overlapping tiles that run side
+# by side. Objects whose longer side, at detection scale, is up to
+# DETECTION_TILE_OBJECT pixels are searched in the tiles, which overlap by
+# that much so each such object fits whole in at least one; larger ones
+# are left to one pass over the whole image that skips the small scales.
+# The two passes share the sizes from half the overlap up, so an object
+# near the boundary keeps all its neighbouring hits in one of them.
+DETECTION_TILED = os.environ.get('DETECTION_TILED', 'false').lower() in ('1', 'true', 'yes')
+DETECTION_TILE_OBJECT = int(os.environ.get('DETECTION_TILE_OBJECT', '160'))
+# Tile side as a multiple of the overlap; larger tiles repeat less work at
+# the seams but leave fewer of them to spread over cores
+TILE_SCALE = 8
+# A box with more than this share of its area inside a larger box of the
+# same class is that object found again, by another tile or pass
+TILE_NMS_OVERLAP = 0.5
+
+# Detections are structured arrays with one row per box; `cls` indexes
+# BOX_CLASSES, which is also the class code the webcam socket sends
+BOX_CLASSES = ('face', 'eye', 'pedestrian', 'vehicle')
+BOX_DTYPE = np.dtype([('cls', 'u1'), ('x', '<i4'), ('y', '<i4'), ('w', '<i4'), ('h', '<i4')])
+FACE, EYE, PEDESTRIAN, VEHICLE = range(len(BOX_CLASSES))
+
+BOX_COLORS = {
+    'face': 'rgba(255, 0, 255, 0.8)',
+    'eye': 'rgba(255, 255, 0, 0.8)',
+    'pedestrian': 'rgba(0, 255, 255, 0.8)',
+    'vehicle': 'rgba(0, 255, 0, 0.8)',
+}
+
+# BGR equivalents of BOX_COLORS for drawing with cv2.rectangle
+DRAW_COLORS = {
+    'face': (255, 0, 255),
+    'eye': (255, 255, 0),
+    'pedestrian': (0, 255, 255),
+    'vehicle': (0, 255, 0),
+}
+
+# Classes each feature produces
+FEATURE_CLASSES = {
+    'face': ('face', 'eye'),
+    'pedestrian': ('pedestrian',),
+    'vehicle': ('vehicle',),
+}
+
+def cascades_installed(name):
+    # Whether every cascade a feature runs is on disk; opencv-python does
+    # not ship haarcascade_car.xml, for one
+    return all(os.path.exists(cv2.data.haarcascades + CASCADE_FILES[cls]) for cls in FEATURE_CLASSES[name])
+
+def parse_features(feature):
+    # A feature may name several, e.g. 'face,vehicle'; order and repeats
+    # are dropped so equivalent requests share a cache key. A combined
+    # request leaves out features whose cascades are not installed rather
+    # than failing the rest; one asked for alone still reports the error.
+    names = {name.strip() for name in feature.split(',')}
+    features = tuple(name for name in FEATURE_CLASSES if name in names)
+    if len(features) > 1:
+        features = tuple(name for name in features if cascades_installed(name)) or features
+    return features
+
+def feature_key(feature):
+    # The feature as it goes into cache keys, the same for any spelling
+    # of one set of features
+    return ','.join(parse_features(feature)) or feature
+
+def make_boxes(rows):
+    if not len(rows):
+        return np.empty(0, dtype=BOX_DTYPE)
+    return np.array([tuple(row) for row in rows], dtype=BOX_DTYPE)
+
+def resolve_max_side(feature, max_side=None):
+    if max_side is not None:
+        return max_side
+    features = parse_features(feature)
+    if len(features) > 1:
+        return {name: DETECTION_MAX_SIDE.get(name, 0) for name in features}
+    return DETECTION_MAX_SIDE.get(features[0] if features else feature, 0)
+
+def detection_scale(shape, feature, max_side=None):
+    max_side = resolve_max_side(feature, max_side)
+    longest = max(shape[:2])
+    return max_side / longest if 0 < max_side < longest else 1.0
+
+def tile_grid(width, height, tile, overlap):
+    # Tiles of at most `tile` pixels overlapping by `overlap`, spread evenly
+    # so an image just over one tile is not searched twice
+    def spans(length):
+        count = max(1, -(-(length - overlap) // (tile - overlap)))
+        step = max(1, -(-(length - overlap) // count))
+        return [(start, min(step + overlap, length - start)) for start in range(0, count * step, step)]
+
+    return [(x, y, w, h) for (y, h) in spans(height) for (x, w) in spans(width)]
+
+def size_limits(cascade, sizes):
+    # detectMultiScale limits for objects whose longer side is within
+    # `sizes` (min, max), either end None for open. Only the window's
+    # longer side is held to the minimum, so the two ends split the scales
+    # cleanly between passes.
+    if sizes is None:
+        return {}
+    min_side, max_side = sizes
+    limits = {}
+    if min_side:
+        width, height = cascade.getOriginalWindowSize()
+        limits['minSize'] = (min_side, 0) if width >= height else (0, min_side)
+    if max_side:
+        limits['maxSize'] = (max_side, max_side)
+    return limits
+
+def suppress_duplicates(boxes, overlap=TILE_NMS_OVERLAP):
+    # Greedy non-maximum suppression within each class. The cascades give
+    # no scores, so the larger box is kept; overlap is measured against the
+    # smaller one, which also drops boxes nested inside another the way
+    # grouping does within a single detectMultiScale call.
+    areas = boxes['w'].astype(np.int64) * boxes['h']
+    x1, y1 = boxes['x'] + boxes['w'], boxes['y'] + boxes['h']
+    kept = []
+    for i in np.argsort(-areas, kind='stable'):
+        others = np.array([j for j in kept if boxes['cls'][j] == boxes['cls'][i]], dtype=np.intp)
+        iw = np.clip(np.minimum(x1[i], x1[others]) - np.maximum(boxes['x'][i], boxes['x'][others]), 0, None)
+        ih = np.clip(np.minimum(y1[i], y1[others]) - np.maximum(boxes['y'][i], boxes['y'][others]), 0, None)
+        if (iw * ih > overlap * areas[i]).any():
+            continue
+        kept.append(i)
+    return boxes[np.sort(np.array(kept, dtype=np.intp))]
+
+class CascadePool:
+    # CascadeClassifier is not safe to call from several threads at once, so
+    # every detection checks out its own instance and returns it afterwards.
+    # Instances are only created when all existing ones are busy, so the pool
+    # settles at the peak number of concurrent detections, and a cascade that
+    # is never used is never parsed. Worker processes inherit the parent's
+    # pools and from then on grow their own.
+
+    def __init__(self, cascade_name):
+        self.cascade_name = cascade_name
+        self.size = 0
+        self.load_seconds = None
+        self.error = None
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _create(self):
+        # A cascade that failed to load keeps failing with the same error
+        # instead of hitting the disk on every request
+        if self.error is not None:
+            raise self.error
+
+        start = time.perf_counter()
+        try:
+            cascade = load_cascade(self.cascade_name)
+        except CascadeUnavailable as e:
+            self.error = e
+            raise
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.size += 1
+            if self.load_seconds is None:
+                self.load_seconds = elapsed
+                CASCADE_LOAD_SECONDS.set(elapsed, self.cascade_name)
+        return cascade
+
+    def prime(self):
+        self._idle.put(self._create())
+
+    @contextmanager
+    def acquire(self):
+        try:
+            cascade = self._idle.get_nowait()
+        except queue.Empty:
+            cascade = self._create()
+        try:
+            yield cascade
+        finally:
+            self._idle.put(cascade)
+
+class DetectorEngine:
+    def __init__(self, cascade_files=CASCADE_FILES, preload=()):
+        # Cascades load on first use; preload names any to parse up front
+        self.pools = {name: CascadePool(filename) for name, filename in cascade_files.items()}
+        for name in preload:
+            self.pools[name].prime()
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+    def executor(self):
+        # Threads for running several features or tiles on one frame.
+        # Created per process, since a pool inherited through fork has no
+        # live threads.
+        with self._executor_lock:
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=max(len(FEATURE_CLASSES), ADMISSION_CPUS))
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def detect(self, img, feature, max_side=None, eye_search=None, tiled=False):
+        with stage('grayscale'):
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if tiled:
+            return self.detect_tiled(gray, feature, max_side, eye_search)
+        return self.detect_gray(gray, feature, max_side, eye_search)
+
+    def detect_eyes(self, eye_cascade, gray, face, eye_search=None):
+        x, y, w, h = face
+        if (eye_search or EYE_SEARCH) == 'full':
+            return eye_cascade.detectMultiScale(gray[y:y+h, x:x+w])
+
+        min_side = max(int(w * EYE_MIN_WIDTH), 1)
+        max_side = max(int(w * EYE_MAX_WIDTH), min_side)
+        return eye_cascade.detectMultiScale(
+            gray[y:y+int(h * EYE_REGION_BOTTOM), x:x+w], EYE_SCALE_FACTOR, 3,
+            minSize=(min_side, min_side), maxSize=(max_side, max_side)
+        )
+
+    def detect_gray(self, gray, feature, max_side=None, eye_search=None):
+        features = parse_features(feature)
+        if len(features) <= 1:
+            with stage('detect'):
+                return self.detect_feature(gray, features[0] if features else feature, max_side, eye_search)
+
+        # One grayscale frame shared by every cascade. Features that search
+        # at the same scale also share the resized copy, and the cascades
+        # run side by side since OpenCV releases the GIL while detecting.
+        with stage('detect'):
+            scales = {name: detection_scale(gray.shape, name, max_side) for name in features}
+            scaled = {
+                scale: gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                for scale in set(scales.values())
+            }
+
+            executor = self.executor()
+            futures = [
+                executor.submit(self.detect_feature, scaled[scales[name]], name, None, eye_search, scales[name])
+                for name in features
+            ]
+            return np.concatenate([future.result() for future in futures])
+
+    def detect_region(self, gray, feature, region, max_side=None, eye_search=None):
+        # Searches only `region` (x, y, w, h) of the frame, at the scale the
+        # whole frame would be searched at so boxes match a full pass. Boxes
+        # come back in frame coordinates.
+        x, y, w, h = region
+        crop = gray[y:y+h, x:x+w]
+
+        boxes = []
+        with stage('detect'):
+            for name in parse_features(feature):
+                scale = detection_scale(gray.shape, name, max_side)
+                if scale < 1.0:
+                    scaled = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                else:
+                    scaled = crop
+                boxes.append(self.detect_feature(scaled, name, None, eye_search, scale))
+
+        boxes = np.concatenate(boxes) if boxes else make_boxes([])
+        boxes['x'] += x
+        boxes['y'] += y
+        return boxes
+
+    def detect_tiled(self, gray, feature, max_side=None, eye_search=None):
+        overlap = DETECTION_TILE_OBJECT
+        tile = overlap * TILE_SCALE
+        executor = self.executor()
+
+        with stage('detect'):
+            searches = []
+            for name in parse_features(feature):
+                scale = detection_scale(gray.shape, name, max_side)
+                if scale < 1.0:
+                    gray_scaled = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                else:
+                    gray_scaled = gray
+                height, width = gray_scaled.shape[:2]
+
+                if max(width, height) <= tile:
+                    searches.append((scale, 0, 0, executor.submit(self.detect_feature, gray_scaled, name, None, eye_search, 1.0)))
+                    continue
+
+                for (x, y, w, h) in tile_grid(width, height, tile, overlap):
+                    searches.append((scale, x, y, executor.submit(
+                        self.detect_feature, gray_scaled[y:y+h, x:x+w], name, None, eye_search, 1.0, (None, overlap)
+                    )))
+                searches.append((scale, 0, 0, executor.submit(
+                    self.detect_feature, gray_scaled, name, None, eye_search, 1.0, (overlap // 2, None)
+                )))
+
+            # Offsets are added at detection scale, then boxes are mapped
+            # back like detect_feature does
+            found = []
+            for scale, x, y, future in searches:
+                boxes = future.result()
+                boxes['x'] += x
+                boxes['y'] += y
+                if scale < 1.0:
+                    for field in ('x', 'y', 'w', 'h'):
+                        boxes[field] = np.rint(boxes[field] / scale)
+                found.append(boxes)
+
+            return suppress_duplicates(np.concatenate(found)) if found else make_boxes([])
+
+    def detect_feature(self, gray, feature, max_side=None, eye_search=None, scale=None, sizes=None):
+        # `scale` says `gray` has already been resized by that factor;
+        # `sizes` limits the longer side of the objects searched for
+        if scale is None:
+            scale = detection_scale(gray.shape, feature, max_side)
+            if scale < 1.0:
+                gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        rows = []
+
+        if feature == 'face':
+            with self.pools['face'].acquire() as face_cascade, self.pools['eye'].acquire() as eye_cascade:
+                faces = face_cascade.detectMultiScale(gray, 1.3, 5, **size_limits(face_cascade, sizes))
+
+                for (x, y, w, h) in faces:
+                    rows.append((FACE, x, y, w, h))
+
+                    eyes = self.detect_eyes(eye_cascade, gray, (x, y, w, h), eye_search)
+
+                    for (ex, ey, ew, eh) in eyes:
+                        rows.append((EYE, x+ex, y+ey, ew, eh))
+
+        elif feature == 'pedestrian':
+            with self.pools['pedestrian'].acquire() as pedestrian_cascade:
+                pedestrians = pedestrian_cascade.detectMultiScale(gray, 1.1, 3, **size_limits(pedestrian_cascade, sizes))
+            rows.extend((PEDESTRIAN, x, y, w, h) for (x, y, w, h) in pedestrians)
+
+        elif feature == 'vehicle':
+            with self.pools['vehicle'].acquire() as car_cascade:
+                vehicles = car_cascade.detectMultiScale(gray, 1.1, 3, **size_limits(car_cascade, sizes))
+            rows.extend((VEHICLE, x, y, w, h) for (x, y, w, h) in vehicles)
+
+        boxes = make_boxes(rows)
+        if scale < 1.0:
+            for field in ('x', 'y', 'w', 'h'):
+                boxes[field] = np.rint(boxes[field] / scale)
+
+        return boxes
+
+# Comma-separated cascades (face, eye, pedestrian, vehicle) to parse at
+# startup rather than on the first request that needs them
+CASCADE_PRELOAD = [name for name in os.environ.get('CASCADE_PRELOAD', '').split(',') if name]
+
+detector = DetectorEngine(preload=CASCADE_PRELOAD)
+
+def detect_objects(img, feature, max_side=None, eye_search=None, tiled=False):
+    return detector.detect(img, feature, max_side, eye_search, tiled)
+
+def count_boxes(boxes):
+    counts = np.bincount(boxes['cls'], minlength=len(BOX_CLASSES))
+    return {label: int(count) for label, count in zip(BOX_CLASSES, counts)}
+
+def summarize_objects(boxes, feature):
+    features = parse_features(feature)
+    if len(features) > 1:
+        return ' '.join(summarize_objects(boxes, name) for name in features)
+    # A combined request may come down to one feature
+    feature = features[0] if features else feature
+
+    counts = count_boxes(boxes)
+
+    if feature == 'face':
+        if counts['face'] > 0 or counts['eye'] > 0:
+            return f"Detected {counts['face']} face(s) and {counts['eye']} eye(s)."
+        return "No faces or eyes detected."
+    elif feature == 'pedestrian':
+        if counts['pedestrian'] > 0:
+            return f"Detected {counts['pedestrian']} pedestrian(s)."
+        return "No pedestrians detected."
+    elif feature == 'vehicle':
+        if counts['vehicle'] > 0:
+            return f"Detected {counts['vehicle']} vehicle(s)."
+        return "No vehicles detected."
+    return None
+
+def boxes_to_json(boxes):
+    return {
+        'boxes': [{'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)} for (_, x, y, w, h) in boxes],
+        'colors': [BOX_COLORS[BOX_CLASSES[cls]] for cls in boxes['cls']],
+    }
+
+def draw_objects(img, boxes):
+    with stage('annotate'):
+        for (cls, x, y, w, h) in boxes:
+            cv2.rectangle(img, (int(x), int(y)), (int(x+w), int(y+h)), DRAW_COLORS[BOX_CLASSES[cls]], 2)
+    return img
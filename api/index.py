@@ -1,297 +1,450 @@
 import os
+import json
+import mimetypes
 import cv2
-import numpy as np
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response, stream_with_context
 import uuid
-import base64
 from werkzeug.utils import secure_filename
 import time
+from detection import (
+    feature_key, decode_image, parse_flag, detect_objects,
+    summarize_objects, boxes_to_json, draw_objects, DETECTION_TILED, resolve_max_side
+)
+from cache import DetectionCache, content_key
+from metrics import init_metrics, stage, label, streamed
+from admission import init_admission, admitted, lanes
+from batch import open_batch, stream_batch
+from storage import StorageManager
+from video import (
+    VIDEO_WORKERS, VIDEO_PIPELINE, VIDEO_KEYFRAME_INTERVAL, VIDEO_MOTION_GATE, resolve_workers,
+    process_video_parallel, process_video_pipelined, format_stage_timings,
+    process_video_tracked, summarize_tracks, process_video_gated, format_motion_stats,
+    video_properties, detect_video_frames, WHOLE_VIDEO, parse_segment, resolve_segment,
+    segment_frames, SegmentReader
+)
+from annotations import ANNOTATION_FORMATS, collect_annotations, annotations_response
+from webcam import WEBCAM_MOTION_GATE, WEBCAM_ROI_SEARCH, WebcamSessions, pacing_hints, detect_session_frame
 
 app = Flask(__name__, 
     template_folder='../templates',
     static_folder='../static'
 )
+init_metrics(app)
+init_admission(app)
 
 # Use /tmp directory for Vercel's serverless environment
 UPLOAD_FOLDER = '/tmp/uploads'
 PROCESSED_FOLDER = '/tmp/processed'
+CACHE_FOLDER = '/tmp/cache'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
-def load_cascade(cascade_name):
-    cascade_path = cv2.data.haarcascades + cascade_name
-    cascade = cv2.CascadeClassifier(cascade_path)
-    if cascade.empty():
-        print(f"Warning: Could not load {cascade_path}")
-    return cascade
+# /tmp is small on serverless hosts (512 MB on Vercel), so the local
+# defaults would overrun it. Rendered outputs get half of it, and leftover
+# uploads and scratch files a quarter. The rest is headroom for what
+# requests are writing between sweeps. Setting RENDER_CACHE_BYTES or
+# STORAGE_QUOTA_BYTES still overrides either share.
+TMP_BYTES = int(os.environ.get('TMP_BYTES', str(512 * 1024 * 1024)))
+
+# Results keyed on upload content, so re-uploads skip the cascades
+cache = DetectionCache(CACHE_FOLDER, max_bytes=int(os.environ.get('RENDER_CACHE_BYTES', str(TMP_BYTES // 2))))
+
+# Leftovers from failed or killed requests are expired and capped too
+storage = StorageManager(
+    [UPLOAD_FOLDER, PROCESSED_FOLDER],
+    quota=int(os.environ.get('STORAGE_QUOTA_BYTES', str(TMP_BYTES // 4)))
+)
+
+# Region search and motion gate state for webcam clients that send a
+# session id, and the viewer count their frames are paced by; lives as
+# long as the warm instance does
+webcam_sessions = WebcamSessions()
+
+def cache_url(path):
+    return f"/cache/{os.path.basename(path)}"
 
-face_cascade = load_cascade('haarcascade_frontalface_default.xml')
-eye_cascade = load_cascade('haarcascade_eye.xml')
-pedestrian_cascade = load_cascade('haarcascade_fullbody.xml')
+# Another instance may answer the follow-up GET for a /cache URL and its
+# /tmp never saw the render. With inline=true the rendered file comes back
+# in the same response: a multipart/form-data body with the JSON result and
+# then the file, streamed from disk. The client has to read all of it
+# first, so images default to inline. Videos default to the /cache link,
+# which can play before the download finishes and supports seeking.
+INLINE_RENDERS = parse_flag(os.environ.get('INLINE_RENDERS'), True)
+INLINE_VIDEO_RENDERS = parse_flag(os.environ.get('INLINE_VIDEO_RENDERS'), False)
 
-try:
-    car_cascade = load_cascade('haarcascade_car.xml')
-except:
-    print("Warning: Car cascade file not found, using frontalface as fallback")
-    car_cascade = face_cascade 
+def render_response(result, rendered_path, inline=INLINE_RENDERS):
+    if not parse_flag(request.form.get('inline'), inline):
+        return jsonify(result)
+
+    # Opened now, so evicting the render meanwhile can't cut the stream short
+    render = open(rendered_path, 'rb')
+    name = os.path.basename(rendered_path)
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    boundary = uuid.uuid4().hex
+
+    def body():
+        with render:
+            yield (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="result"\r\n'
+                f'Content-Type: application/json\r\n\r\n{json.dumps(result)}\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="render"; filename="{name}"\r\n'
+                f'Content-Type: {mimetype}\r\n\r\n'
+            ).encode()
+            yield from iter(lambda: render.read(64 * 1024), b'')
+            yield f'\r\n--{boundary}--\r\n'.encode()
+
+    return Response(body(), mimetype=f'multipart/form-data; boundary={boundary}')
+
+def store_render(key, image):
+    # Encode to a scratch name first so a concurrent request for the same
+    # key never serves a half-written file
+    processed_path = os.path.join(PROCESSED_FOLDER, f"processed_{uuid.uuid4()}.jpg")
+    with stage('encode'):
+        cv2.imwrite(processed_path, image)
+
+    rendered_path = cache.render_path(key, '.jpg')
+    os.replace(processed_path, rendered_path)
+    cache.put_render(key, rendered_path)
+    return rendered_path
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/detect', methods=['POST'])
+@admitted('image')
 def detect():
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
     
     file = request.files['image']
     feature = request.form.get('feature', 'face')
+    label(feature)
+    max_side = request.form.get('max_side', type=int)
+    tiled = parse_flag(request.form.get('tiled'), DETECTION_TILED)
     
     if file.filename == '':
         return jsonify({'error': 'No image selected'}), 400
     
-    filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(file_path)
+    key, upload_size = content_key(
+        file.stream, feature=feature_key(feature), max_side=resolve_max_side(feature, max_side), tiled=tiled
+    )
+    cached = cache.get_result(key)
 
-    try:
-        processed_image, detections = process_image(file_path, feature)
+    rendered_path = cache.get_render(key)
+    if cached is not None and rendered_path is not None:
+        cache.record_hit(upload_size + os.path.getsize(rendered_path))
+        return render_response({
+            'image_url': cache_url(rendered_path),
+            'detections': cached['detections'],
+            'cached': True
+        }, rendered_path)
 
-        processed_filename = f"processed_{unique_filename}"
-        processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
-        cv2.imwrite(processed_path, processed_image)
+    try:
+        # Decode straight from the upload buffer; the upload never touches
+        # /tmp. Cached boxes are redrawn instead of running the cascades again.
+        if cached is not None:
+            cache.record_hit(upload_size)
+        else:
+            cache.record_miss()
 
-        # Convert processed image to base64 for serverless environment
-        _, buffer = cv2.imencode('.jpg', processed_image)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
+        processed_image, detections, objects = process_image(
+            decode_image(file), feature, max_side, cached and cached['boxes'], tiled
+        )
+        if cached is None:
+            cache.put_result(key, {'boxes': objects, 'detections': detections})
 
-        # Clean up temporary files
-        os.remove(file_path)
-        os.remove(processed_path)
+        rendered_path = store_render(key, processed_image)
 
-        return jsonify({
-            'image_data': f"data:image/jpeg;base64,{img_base64}",
-            'detections': detections
-        })
+        return render_response({
+            'image_url': cache_url(rendered_path),
+            'detections': detections,
+            'cached': cached is not None
+        }, rendered_path)
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/detect_video', methods=['POST'])
+@admitted('video')
 def detect_video():
     if 'video' not in request.files:
         return jsonify({'error': 'No video provided'}), 400
     
     file = request.files['video']
     feature = request.form.get('feature', 'face')
+    label(feature)
+    max_side = request.form.get('max_side', type=int)
+    workers = resolve_workers(request.form.get('workers', VIDEO_WORKERS, type=int))
+    pipeline = parse_flag(request.form.get('pipeline'), VIDEO_PIPELINE)
+    keyframe_interval = request.form.get('keyframe_interval', VIDEO_KEYFRAME_INTERVAL, type=int)
+    motion = parse_flag(request.form.get('motion'), VIDEO_MOTION_GATE)
+    try:
+        segment_options = parse_segment(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     if file.filename == '':
         return jsonify({'error': 'No video selected'}), 400
 
     filename = secure_filename(file.filename)
+
+    # Workers do not change the output, so they stay out of the key;
+    # pipelining adds stage timings to the response, so it goes in
+    key, upload_size = content_key(
+        file.stream, feature=feature_key(feature), max_side=resolve_max_side(feature, max_side),
+        pipeline=pipeline, keyframe_interval=keyframe_interval, motion=motion, segment=segment_options
+    )
+    cached = cache.get_result(key)
+    rendered_path = cache.get_render(key)
+    if cached is not None and rendered_path is not None:
+        cache.record_hit(upload_size + os.path.getsize(rendered_path))
+
+        return render_response({
+            'video_url': cache_url(rendered_path),
+            'original_filename': filename,
+            'detections': cached['detections'],
+            'cached': True,
+            **cached['stats']
+        }, rendered_path, INLINE_VIDEO_RENDERS)
+    cache.record_miss()
+
     unique_filename = f"{uuid.uuid4()}_{filename}"
     file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(file_path)
+    processed_filename = f"processed_{unique_filename}"
+    processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
+    storage.acquire(file_path, processed_path)
+    with stage('save'):
+        file.save(file_path)
     
     try:
-        processed_filename = f"processed_{unique_filename}"
-        processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
 
-        processed_video, detections = process_video(file_path, processed_path, feature)
+        stats = {}
+        processed_video, detections = process_video(
+            file_path, processed_path, feature, workers, pipeline,
+            keyframe_interval, max_side, stats, motion,
+            resolve_segment(file_path, segment_options)
+        )
 
-        # Read the processed video file and convert to base64
-        with open(processed_path, 'rb') as video_file:
-            video_base64 = base64.b64encode(video_file.read()).decode('utf-8')
+        # The rendered video stays in the cache and is streamed from there
+        rendered_path = cache.render_path(key, os.path.splitext(filename)[1])
+        os.replace(processed_path, rendered_path)
+        cache.put_render(key, rendered_path)
+        # Hits answer with the same shape, stats included
+        cache.put_result(key, {'detections': detections, 'stats': stats})
 
         # Clean up temporary files
         os.remove(file_path)
-        os.remove(processed_path)
 
-        return jsonify({
-            'video_data': f"data:video/mp4;base64,{video_base64}",
+        return render_response({
+            'video_url': cache_url(rendered_path),
             'original_filename': filename,
-            'detections': detections
-        })
+            'detections': detections,
+            'cached': False,
+            **stats
+        }, rendered_path, INLINE_VIDEO_RENDERS)
     except Exception as e:
         if os.path.exists(file_path):
             os.remove(file_path)
         if os.path.exists(processed_path):
             os.remove(processed_path)
+        return jsonify({'error': str(e)}), 400 if isinstance(e, ValueError) else 500
+    finally:
+        storage.release(file_path, processed_path)
+
+@app.route('/annotate_video', methods=['POST'])
+@admitted('video')
+def annotate_video():
+    # Per-frame boxes only: nothing is drawn or encoded, and the result
+    # comes back as JSON rows, CSV or a NumPy .npz archive
+    if 'video' not in request.files:
+        return jsonify({'error': 'No video provided'}), 400
+
+    file = request.files['video']
+    feature = request.form.get('feature', 'face')
+    label(feature)
+    max_side = request.form.get('max_side', type=int)
+    workers = resolve_workers(request.form.get('workers', VIDEO_WORKERS, type=int))
+    fmt = request.form.get('format', 'json').lower()
+    if fmt not in ANNOTATION_FORMATS:
+        return jsonify({'error': f"Unknown format '{fmt}', expected one of {', '.join(ANNOTATION_FORMATS)}"}), 400
+    try:
+        segment_options = parse_segment(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if file.filename == '':
+        return jsonify({'error': 'No video selected'}), 400
+
+    filename = secure_filename(file.filename)
+    export_name = f"{os.path.splitext(filename)[0]}_annotations"
+
+    # The format only changes the encoding, so one cached result serves all of them
+    key, upload_size = content_key(
+        file.stream, feature=feature_key(feature), max_side=resolve_max_side(feature, max_side), annotations=True,
+        segment=segment_options
+    )
+    cached = cache.get_result(key)
+    if cached is not None:
+        cache.record_hit(upload_size)
+        return annotations_response(cached['annotations'], cached['info'], fmt, export_name)
+    cache.record_miss()
+
+    file_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{filename}")
+    storage.acquire(file_path)
+    with stage('save'):
+        file.save(file_path)
+
+    try:
+        segment = resolve_segment(file_path, segment_options)
+        info = {'feature': feature, **video_properties(file_path), 'start_frame': segment[0], 'stride': segment[2]}
+        frame_objects = detect_video_frames(file_path, feature, workers, max_side, segment=segment)
+        info['frames'] = len(frame_objects)
+        annotations = collect_annotations(frame_objects, segment_frames(segment, len(frame_objects)))
+        cache.put_result(key, {'annotations': annotations, 'info': info})
+
+        return annotations_response(annotations, info, fmt, export_name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        storage.release(file_path)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+@app.route('/detect_batch', methods=['POST'])
+def detect_batch():
+    # Images are read from the body as detection keeps up and reported one
+    # JSON line each as they finish, so batch size does not bound memory
+    try:
+        items, fields = open_batch(request)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return Response(stream_with_context(streamed(stream_batch(items, fields, cache))), mimetype='application/x-ndjson')
+
+@app.route('/cache/<name>')
+def cached_render(name):
+    # Rendered images and videos are sent as files rather than inlined as
+    # base64: the body streams from disk in chunks and Range requests let
+    # the browser start playback early and seek
+    return send_from_directory(CACHE_FOLDER, name, conditional=True)
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(cache.stats())
+
+@app.route('/storage_stats')
+def storage_stats():
+    return jsonify(storage.stats())
 
 @app.route('/detect_webcam', methods=['POST'])
+@admitted('webcam')
 def detect_webcam():
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
     
+    start = time.perf_counter()
     file = request.files['image']
     feature = request.form.get('feature', 'face')
+    label(feature)
+    max_side = request.form.get('max_side', type=int)
+    motion = parse_flag(request.form.get('motion'), WEBCAM_MOTION_GATE)
+    # Sessions are also how viewers are counted for pacing
+    session = webcam_sessions.get(request.form.get('session'))
     
     if file.filename == '':
         return jsonify({'error': 'No image selected'}), 400
 
-    filename = "webcam_frame.jpg"
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(file_path)
-
     try:
-        img = cv2.imread(file_path)
-        
-        boxes = []
-        colors = []
-        detections = []
-        
-        if feature == 'face':
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        img = decode_image(file)
+        stats = {}
+        if session is not None and (motion or WEBCAM_ROI_SEARCH):
+            objects, stats = detect_session_frame(session, img, feature, max_side, motion)
+        else:
+            objects = detect_objects(img, feature, max_side=max_side)
+        summary = summarize_objects(objects, feature)
 
-            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-            
-            face_count = 0
-            eye_count = 0
-            
-            for (x, y, w, h) in faces:
-                boxes.append({'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)})
-                colors.append('rgba(255, 0, 255, 0.8)')
-                face_count += 1
-
-                roi_gray = gray[y:y+h, x:x+w]
-                eyes = eye_cascade.detectMultiScale(roi_gray)
-                
-                for (ex, ey, ew, eh) in eyes:
-                    boxes.append({'x': int(x+ex), 'y': int(y+ey), 'width': int(ew), 'height': int(eh)})
-                    colors.append('rgba(255, 255, 0, 0.8)')
-                    eye_count += 1
-            
-            if face_count > 0 or eye_count > 0:
-                detections.append(f"Detected {face_count} face(s) and {eye_count} eye(s).")
-            else:
-                detections.append("No faces or eyes detected.")
-                
-        elif feature == 'pedestrian':
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-            pedestrians = pedestrian_cascade.detectMultiScale(gray, 1.1, 3)
-            
-            for (x, y, w, h) in pedestrians:
-                boxes.append({'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)})
-                colors.append('rgba(0, 255, 255, 0.8)')
-            
-            if len(pedestrians) > 0:
-                detections.append(f"Detected {len(pedestrians)} pedestrian(s).")
-            else:
-                detections.append("No pedestrians detected.")
-                
-        elif feature == 'vehicle':
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            vehicles = car_cascade.detectMultiScale(gray, 1.1, 3)
-            
-            for (x, y, w, h) in vehicles:
-                boxes.append({'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)})
-                colors.append('rgba(0, 255, 0, 0.8)')
-            
-            if len(vehicles) > 0:
-                detections.append(f"Detected {len(vehicles)} vehicle(s).")
-            else:
-                detections.append("No vehicles detected.")
-        
-        os.remove(file_path)
-        
         return jsonify({
-            'boxes': boxes,
-            'colors': colors,
-            'detections': detections
+            **boxes_to_json(objects),
+            'detections': [summary] if summary else [],
+            'pacing': pacing_hints(lanes['webcam'], time.perf_counter() - start, webcam_sessions.viewers()),
+            **stats
         })
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
         return jsonify({'error': str(e)}), 500
 
-def process_image(image_path, feature):
-    img = cv2.imread(image_path)
-    
-    detections = []
-    
-    if feature == 'face':
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+def process_image(image, feature, max_side=None, objects=None, tiled=False):
+    if isinstance(image, str):
+        with stage('decode'):
+            img = cv2.imread(image)
+    else:
+        img = image
 
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        
-        face_count = 0
-        eye_count = 0
-        
-        for (x, y, w, h) in faces:
-            cv2.rectangle(img, (x, y), (x+w, y+h), (255, 0, 255), 2)
-            face_count += 1
+    if objects is None:
+        objects = detect_objects(img, feature, max_side=max_side, tiled=tiled)
+    draw_objects(img, objects)
 
-            roi_gray = gray[y:y+h, x:x+w]
-            eyes = eye_cascade.detectMultiScale(roi_gray)
-            
-            for (ex, ey, ew, eh) in eyes:
-                cv2.rectangle(img, (x+ex, y+ey), (x+ex+ew, y+ey+eh), (255, 255, 0), 2)
-                eye_count += 1
-        
-        if face_count > 0 or eye_count > 0:
-            detections.append(f"Detected {face_count} face(s) and {eye_count} eye(s).")
-        else:
-            detections.append("No faces or eyes detected.")
-            
-    elif feature == 'pedestrian':
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    summary = summarize_objects(objects, feature)
+    return img, [summary] if summary else [], objects
 
-        pedestrians = pedestrian_cascade.detectMultiScale(gray, 1.1, 3)
-        
-        for (x, y, w, h) in pedestrians:
-            cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 255), 2)
-        
-        if len(pedestrians) > 0:
-            detections.append(f"Detected {len(pedestrians)} pedestrian(s).")
-        else:
-            detections.append("No pedestrians detected.")
-            
-    elif feature == 'vehicle':
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        vehicles = car_cascade.detectMultiScale(gray, 1.1, 3)
-        
-        for (x, y, w, h) in vehicles:
-            cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 0), 2)
-        
-        if len(vehicles) > 0:
-            detections.append(f"Detected {len(vehicles)} vehicle(s).")
-        else:
-            detections.append("No vehicles detected.")
-            
-    return img, detections
+def process_video(video_path, output_path, feature, workers=1, pipeline=False,
+                  keyframe_interval=0, max_side=None, stats=None, motion=False, segment=WHOLE_VIDEO):
+    # Every path reads only the segment's frames, and the output video and
+    # per-frame lines cover just those, numbered as in the source
+    if stats is not None and segment != WHOLE_VIDEO:
+        stats['segment'] = dict(zip(('start_frame', 'end_frame', 'stride'), segment))
 
-def process_video(video_path, output_path, feature):
-    cap = cv2.VideoCapture(video_path)
-    
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    if keyframe_interval > 0:
+        frame_objects, tracking = process_video_tracked(
+            video_path, output_path, feature, keyframe_interval, max_side, segment=segment
+        )
+        if stats is not None:
+            stats['tracking'] = tracking
+        return output_path, summarize_tracks(feature, len(frame_objects), tracking)
+
+    if motion:
+        frame_objects, motion_stats = process_video_gated(video_path, output_path, feature, max_side, segment=segment)
+        if stats is not None:
+            stats['motion'] = motion_stats
+    elif pipeline:
+        frame_objects, timings = process_video_pipelined(video_path, output_path, feature, workers, max_side, segment=segment)
+        if stats is not None:
+            stats['stage_timings'] = timings
+    elif workers > 1:
+        frame_objects = process_video_parallel(video_path, output_path, feature, workers, max_side, segment=segment)
+
+    if motion or pipeline or workers > 1:
+        total_detections = []
+        for frame_count, objects in zip(segment_frames(segment, len(frame_objects)), frame_objects):
+            summary = summarize_objects(objects, feature)
+            if summary:
+                total_detections.append(f"Frame {frame_count}: {summary}")
+        if motion:
+            total_detections.append(format_motion_stats(motion_stats))
+        elif pipeline:
+            total_detections.append(format_stage_timings(timings, len(frame_objects), workers))
+
+        return output_path, total_detections
+
+    cap = SegmentReader(video_path, segment)
     
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, fps, (frame_width, frame_height))
+    out = cv2.VideoWriter(output_path, fourcc, cap.fps, (cap.width, cap.height))
     
     total_detections = []
-    frame_count = 0
     
     while cap.isOpened():
         ret, frame = cap.read()
         if not ret:
             break
             
-        processed_frame, frame_detections = process_image(frame, feature)
-        out.write(processed_frame)
+        processed_frame, frame_detections, _ = process_image(frame, feature, max_side)
+        with stage('encode'):
+            out.write(processed_frame)
         
         if frame_detections:
-            total_detections.extend([f"Frame {frame_count}: {detection}" for detection in frame_detections])
-        
-        frame_count += 1
+            total_detections.extend([f"Frame {cap.frame}: {detection}" for detection in frame_detections])
     
     cap.release()
     out.release()
@@ -0,0 +1,136 @@
+import os
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+
+# Videos processed at once; each job may still fan out over VIDEO_WORKERS
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '1'))
+# Jobs waiting for a worker before submissions are turned away
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', '16'))
+# Finished jobs kept around for their results, oldest dropped first
+JOB_HISTORY = int(os.environ.get('JOB_HISTORY', '256'))
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, total_frames=0):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.total_frames = total_frames
+        self.frames_processed = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    def advance(self, frames_processed):
+        self.frames_processed = frames_processed
+
+    def to_json(self):
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'frames_processed': self.frames_processed,
+            'total_frames': self.total_frames,
+            'progress': None,
+            'eta_seconds': None,
+        }
+
+        if self.status == 'done':
+            data['progress'] = 1.0
+            data['eta_seconds'] = 0.0
+        elif self.total_frames:
+            data['progress'] = min(self.frames_processed / self.total_frames, 1.0)
+
+        # The rate so far is the best guess for the rest of the clip
+        if self.status == 'running' and self.frames_processed and self.total_frames:
+            elapsed = time.time() - self.started_at
+            remaining = max(self.total_frames - self.frames_processed, 0)
+            data['eta_seconds'] = round(elapsed / self.frames_processed * remaining, 2)
+
+        if self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+class JobQueue:
+    # In-process stand-in for a broker: a bounded queue drained by a fixed
+    # set of worker threads. Jobs and their results live in memory, so they
+    # do not survive a restart.
+
+    def __init__(self, workers=JOB_WORKERS, depth=JOB_QUEUE_DEPTH, history=JOB_HISTORY):
+        self.workers = max(1, workers)
+        self.history = history
+        self.pending = queue.Queue(depth)
+        self.jobs = OrderedDict()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Started on first use rather than at import, so processes forked
+        # for video detection do not inherit idle worker threads
+        if not self._threads:
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, *args, total_frames=0, **kwargs):
+        # fn is called as fn(*args, progress=job.advance, **kwargs) and its
+        # return value becomes the job result
+        job = Job(total_frames)
+        with self._lock:
+            self._start()
+            try:
+                self.pending.put_nowait((job, fn, args, kwargs))
+            except queue.Full:
+                raise QueueFull(f"Job queue is full ({self.pending.maxsize} waiting)")
+            self._remember(job)
+        return job
+
+    def completed(self, result, total_frames=0):
+        # A job that needs no work, e.g. a cache hit, so clients poll the
+        # same way either way
+        job = Job(total_frames)
+        job.status = 'done'
+        job.frames_processed = total_frames
+        job.started_at = job.finished_at = job.submitted_at
+        job.result = result
+        with self._lock:
+            self._remember(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _remember(self, job):
+        self.jobs[job.id] = job
+        finished = [key for key, old in self.jobs.items() if old.status in ('done', 'failed')]
+        for key in finished[:max(len(finished) - self.history, 0)]:
+            del self.jobs[key]
+
+    def _work(self):
+        while True:
+            job, fn, args, kwargs = self.pending.get()
+            job.status = 'running'
+            job.started_at = time.time()
+            try:
+                job.result = fn(*args, progress=job.advance, **kwargs)
+                job.status = 'done'
+            except Exception as e:
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                job.finished_at = time.time()
+                self.pending.task_done()
+
+    def stats(self):
+        with self._lock:
+            counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return {'workers': self.workers, 'queue_depth': self.pending.maxsize, **counts}
@@ -0,0 +1,216 @@
+import os
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+from flask import request, Response
+
+# With metrics off, stages are a shared no-op context and no hooks or
+# /metrics route are installed
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Seconds; wide enough for a webcam frame and a whole video
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + format_labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels):
+        self.inc(*labels, amount=-1)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self.values[labels] = value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        names = self.labels + ('le',)
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket{format_labels(names, key + (bound,))}", cumulative))
+                samples.append((f"{self.name}_sum{format_labels(self.labels, key)}", total))
+                samples.append((f"{self.name}_count{format_labels(self.labels, key)}", cumulative))
+        return samples
+
+REQUESTS = Counter('detection_requests_total', 'Requests by endpoint and status code', ('endpoint', 'status'))
+ERRORS = Counter('detection_request_errors_total', 'Requests that failed with a 5xx or an exception', ('endpoint',))
+IN_FLIGHT = Gauge('detection_requests_in_flight', 'Requests being handled', ('endpoint',))
+REQUEST_SECONDS = Histogram('detection_request_duration_seconds', 'Request time', ('endpoint', 'feature'))
+STAGE_SECONDS = Histogram(
+    'detection_stage_duration_seconds', 'Time per request spent in each stage, summed over frames and threads',
+    ('endpoint', 'feature', 'stage')
+)
+CASCADE_LOAD_SECONDS = Gauge('detection_cascade_load_seconds', 'Time to parse each cascade the first time it was used', ('cascade',))
+STORAGE_BYTES = Gauge('detection_storage_bytes', 'Bytes on disk per managed folder, as of the last sweep', ('directory',))
+STORAGE_FILES = Gauge('detection_storage_files', 'Files per managed folder, as of the last sweep', ('directory',))
+STORAGE_DELETED = Counter('detection_storage_deleted_total', 'Files removed by the storage janitor', ('directory', 'reason'))
+ADMISSION_ACTIVE = Gauge('detection_admission_active', 'Detections running per admission lane', ('lane',))
+ADMISSION_WAITING = Gauge('detection_admission_waiting', 'Requests waiting for a slot per admission lane', ('lane',))
+ADMISSION_WAIT_SECONDS = Histogram('detection_admission_wait_seconds', 'Time admitted requests waited for a slot', ('lane',))
+ADMISSION_REJECTED = Counter('detection_admission_rejected_total', 'Requests turned away with 429', ('lane', 'reason'))
+METRICS = (
+    REQUESTS, ERRORS, IN_FLIGHT, REQUEST_SECONDS, STAGE_SECONDS, CASCADE_LOAD_SECONDS,
+    STORAGE_BYTES, STORAGE_FILES, STORAGE_DELETED,
+    ADMISSION_ACTIVE, ADMISSION_WAITING, ADMISSION_WAIT_SECONDS, ADMISSION_REJECTED
+)
+
+class RequestTimings:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.feature = ''
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.status = None
+        self.streaming = False
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+# Timings for the request being handled. Work handed to other threads
+# carries it along through bind().
+current = contextvars.ContextVar('request_timings', default=None)
+
+@contextmanager
+def _timed(stage):
+    timings = current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(stage, time.perf_counter() - start)
+
+def stage(name):
+    return _timed(name) if METRICS_ENABLED else nullcontext()
+
+def label(feature):
+    # Feature names come from the client, so the label is the canonical
+    # set of known features and anything else shares 'other'. That keeps
+    # the series count bounded. Imported here as detection imports metrics.
+    from detection import parse_features
+    timings = current.get()
+    if timings is not None:
+        timings.feature = ','.join(parse_features(feature or '')) or 'other'
+
+def bind(fn):
+    # Runs fn in a copy of the caller's context, so stages timed on a
+    # worker thread count towards the request that queued them
+    if not METRICS_ENABLED or current.get() is None:
+        return fn
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+def finish(timings, error=None):
+    current.set(None)
+
+    status = 500 if error is not None or timings.status is None else timings.status
+    IN_FLIGHT.dec(timings.endpoint)
+    REQUESTS.inc(timings.endpoint, str(status))
+    if status >= 500:
+        ERRORS.inc(timings.endpoint)
+
+    REQUEST_SECONDS.observe(time.perf_counter() - timings.start, timings.endpoint, timings.feature)
+    for name, seconds in timings.stages.items():
+        STAGE_SECONDS.observe(seconds, timings.endpoint, timings.feature, name)
+
+def streamed(body):
+    # A streamed body keeps working after the view returns and teardown
+    # has run, so its request is recorded when the stream ends instead
+    timings = current.get()
+    if timings is None:
+        return body
+    timings.streaming = True
+
+    def generate():
+        try:
+            yield from body
+        finally:
+            finish(timings)
+    return generate()
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name} {value:g}" if isinstance(value, float) else f"{name} {value}" for name, value in metric.samples())
+    return '\n'.join(lines) + '\n'
+
+def init_metrics(app):
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_timings():
+        endpoint = request.endpoint or 'unknown'
+        current.set(RequestTimings(endpoint))
+        IN_FLIGHT.inc(endpoint)
+
+    @app.after_request
+    def server_timing(response):
+        # Streamed bodies (e.g. /detect_batch) are still running here, so
+        # their header only covers what happened before the first byte
+        timings = current.get()
+        if timings is not None:
+            parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.stages.items()]
+            parts.append(f"total;dur={(time.perf_counter() - timings.start) * 1000:.1f}")
+            response.headers['Server-Timing'] = ', '.join(parts)
+            timings.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_timings(error=None):
+        timings = current.get()
+        if timings is not None and not timings.streaming:
+            finish(timings, error)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+from metrics import STORAGE_BYTES, STORAGE_FILES, STORAGE_DELETED
+
+# Uploads and intermediate outputs older than this are deleted
+STORAGE_TTL_SECONDS = int(os.environ.get('STORAGE_TTL_SECONDS', str(60 * 60)))
+# Combined size of the managed folders; oldest files go first when over
+STORAGE_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', str(1024 * 1024 * 1024)))
+# How often the janitor sweeps
+STORAGE_SWEEP_SECONDS = int(os.environ.get('STORAGE_SWEEP_SECONDS', '60'))
+
+class StorageManager:
+    # Keeps the upload and scratch folders bounded by age and total size.
+    # Paths a request or job is still working on are leased and skipped by
+    # every sweep; leases are counted so overlapping users of one path are
+    # fine.
+
+    def __init__(self, folders, ttl=STORAGE_TTL_SECONDS, quota=STORAGE_QUOTA_BYTES, interval=STORAGE_SWEEP_SECONDS):
+        self.folders = folders
+        self.ttl = ttl
+        self.quota = quota
+        self.interval = interval
+        self.leases = {}
+        self._lock = threading.Lock()
+        self._janitor = None
+
+    def acquire(self, *paths):
+        self._start()
+        with self._lock:
+            for path in paths:
+                self.leases[path] = self.leases.get(path, 0) + 1
+
+    def release(self, *paths):
+        with self._lock:
+            for path in paths:
+                count = self.leases.get(path, 0) - 1
+                if count > 0:
+                    self.leases[path] = count
+                else:
+                    self.leases.pop(path, None)
+
+    def _start(self):
+        # Started on first use rather than at import, like the job workers
+        with self._lock:
+            if self._janitor is None and self.interval > 0:
+                self._janitor = threading.Thread(target=self._run, daemon=True)
+                self._janitor.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Storage sweep failed: {e}")
+
+    def scan(self):
+        files = []
+        for folder in self.folders:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path, folder))
+                except FileNotFoundError:
+                    pass
+        return files
+
+    def _delete(self, path, folder, reason):
+        with self._lock:
+            if path in self.leases:
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                return False
+        STORAGE_DELETED.inc(os.path.basename(folder), reason)
+        return True
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        files = sorted(self.scan())
+        kept = []
+        deleted = {'expired': 0, 'quota': 0}
+
+        for (mtime, size, path, folder) in files:
+            if self.ttl > 0 and now - mtime > self.ttl and self._delete(path, folder, 'expired'):
+                deleted['expired'] += 1
+            else:
+                kept.append((mtime, size, path, folder))
+
+        # Oldest first until the folders fit; leased files stay and count
+        total = sum(size for (_, size, _, _) in kept)
+        remaining = []
+        for (mtime, size, path, folder) in kept:
+            if total > self.quota and self._delete(path, folder, 'quota'):
+                total -= size
+                deleted['quota'] += 1
+            else:
+                remaining.append((size, folder))
+
+        usage = self.usage(remaining)
+        for folder, (files_count, size) in usage.items():
+            STORAGE_FILES.set(files_count, os.path.basename(folder))
+            STORAGE_BYTES.set(size, os.path.basename(folder))
+        return deleted
+
+    def usage(self, entries=None):
+        if entries is None:
+            entries = [(size, folder) for (_, size, _, folder) in self.scan()]
+        usage = {folder: (0, 0) for folder in self.folders}
+        for size, folder in entries:
+            count, total = usage[folder]
+            usage[folder] = (count + 1, total + size)
+        return usage
+
+    def stats(self):
+        with self._lock:
+            leased = len(self.leases)
+        return {
+            'folders': {
+                os.path.basename(folder): {'files': count, 'bytes': size}
+                for folder, (count, size) in self.usage().items()
+            },
+            'leased': leased,
+            'ttl_seconds': self.ttl,
+            'quota_bytes': self.quota,
+        }
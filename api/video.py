@@ -0,0 +1,668 @@
+import os
+import cv2
+import math
+import time
+import queue
+import threading
+from metrics import stage, bind
+from admission import VIDEO_MAX_WORKERS, OPENCV_THREADS
+import numpy as np
+from detection import BOX_CLASSES, FEATURE_CLASSES, parse_features, detector, detect_objects, draw_objects, make_boxes
+
+# Default worker count for /detect_video; 1 keeps the original single-core loop
+VIDEO_WORKERS = int(os.environ.get('VIDEO_WORKERS', '1'))
+
+# Run /detect_video as overlapping decode/detect/encode stages by default
+VIDEO_PIPELINE = os.environ.get('VIDEO_PIPELINE', 'false').lower() in ('1', 'true', 'yes')
+
+# Ranges per worker; more than one evens out chunks where detection is slower
+CHUNKS_PER_WORKER = 2
+
+# Frames buffered between pipeline stages; bounds memory on large clips
+PIPELINE_QUEUE_SIZE = 8
+
+# Run the cascades every N frames and track boxes in between; 0 disables
+VIDEO_KEYFRAME_INTERVAL = int(os.environ.get('VIDEO_KEYFRAME_INTERVAL', '0'))
+
+# Template match score below which a track counts as lost
+TRACK_MIN_SCORE = 0.6
+# Overlap needed for a keyframe detection to continue an existing track
+TRACK_MATCH_IOU = 0.3
+# Search window around the previous box, as a fraction of its size
+TRACK_SEARCH_MARGIN = 0.5
+
+# Skip detection on frames that have not changed since the last detected
+# one, and search only the changed area of those that have
+VIDEO_MOTION_GATE = os.environ.get('VIDEO_MOTION_GATE', 'false').lower() in ('1', 'true', 'yes')
+
+# The part of a clip to process, in source frames: start up to end (end
+# exclusive, None for the rest of the clip), taking every stride-th frame
+WHOLE_VIDEO = (0, None, 1)
+
+# Longest side of the downscaled copy the motion gate compares
+MOTION_SIDE = 160
+# Grey-level change for a pixel of that copy to count as moving
+MOTION_THRESHOLD = 25
+# Fraction of pixels that must move before detection runs again
+MOTION_MIN_AREA = 0.002
+# Padding around the changed area, as a fraction of the frame's longest side
+MOTION_MARGIN = 0.05
+# Changed areas larger than this fraction of the frame search the whole frame
+MOTION_FULL_FRAME = 0.5
+
+def resolve_workers(requested):
+    return max(1, min(requested or 1, VIDEO_MAX_WORKERS))
+
+def count_frames(video_path, segment=WHOLE_VIDEO):
+    # Container estimate; good enough for progress, not for slicing
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    start, end, stride = segment
+    end = total_frames if end is None else min(end, total_frames)
+    return max(-(-(end - start) // stride), 0)
+
+def parse_number(form, name, kind):
+    # Unlike form.get(type=...), a value that does not parse is an error
+    # rather than silently missing
+    value = form.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        number = kind(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got '{value}'")
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be finite")
+    return number
+
+def parse_segment(form):
+    # start and end are seconds into the clip; sample_fps picks the stride
+    # from the clip's frame rate and wins over an explicit stride
+    options = {
+        'start': parse_number(form, 'start', float),
+        'end': parse_number(form, 'end', float),
+        'stride': parse_number(form, 'stride', int),
+        'sample_fps': parse_number(form, 'sample_fps', float),
+    }
+    if options['start'] is not None and options['start'] < 0:
+        raise ValueError('start must not be negative')
+    if options['end'] is not None and options['end'] <= (options['start'] or 0):
+        raise ValueError('end must be after start')
+    if options['stride'] is not None and options['stride'] < 1:
+        raise ValueError('stride must be at least 1')
+    if options['sample_fps'] is not None and options['sample_fps'] <= 0:
+        raise ValueError('sample_fps must be positive')
+    return options
+
+def resolve_segment(video_path, options):
+    # Request options from parse_segment as a (start, end, stride) segment
+    if options is None or not any(value is not None for value in options.values()):
+        return WHOLE_VIDEO
+
+    fps = video_properties(video_path)['fps']
+    if not fps and (options['start'] or options['end'] is not None or options['sample_fps']):
+        raise ValueError('The video has no frame rate to convert times into frames')
+
+    def frames(value, name):
+        # Finite input can still overflow once scaled by the frame rate
+        if not math.isfinite(value):
+            raise ValueError(f"{name} is out of range")
+        return int(round(value))
+
+    start = frames((options['start'] or 0) * fps, 'start')
+    end = frames(options['end'] * fps, 'end') if options['end'] is not None else None
+    stride = options['stride'] or 1
+    if options['sample_fps']:
+        stride = max(1, frames(fps / options['sample_fps'], 'sample_fps'))
+    return (start, end, stride)
+
+def segment_frames(segment, count):
+    # Source frame numbers of the first `count` frames of a segment
+    start, _, stride = segment
+    return np.arange(count) * stride + start
+
+class SegmentReader:
+    # A cv2.VideoCapture that returns only a segment's frames. It seeks
+    # straight to the start instead of decoding the frames before it, and
+    # frames between samples are grabbed, skipping the colour conversion
+    # and copy out of the decoder. fps is the rate of the frames it
+    # returns, so writing them at that rate keeps the clip's timing.
+
+    def __init__(self, video_path, segment=WHOLE_VIDEO):
+        self.cap = cv2.VideoCapture(video_path)
+        self.start, self.end, self.stride = segment
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) / self.stride
+        # Source frame numbers of the next frame to return and the last one
+        self.next = self.start
+        self.frame = None
+        self.position = 0
+        if self.start:
+            with stage('seek'):
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+            self.position = self.start
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self):
+        if self.end is not None and self.next >= self.end:
+            return False, None
+
+        with stage('decode'):
+            while self.position < self.next:
+                if not self.cap.grab():
+                    return False, None
+                self.position += 1
+            ret, frame = self.cap.read()
+        self.position += 1
+        self.frame = self.next
+        self.next += self.stride
+        return ret, frame
+
+    def release(self):
+        self.cap.release()
+
+def split_frame_ranges(total_frames, chunks):
+    chunks = max(1, min(chunks, total_frames))
+    size = -(-total_frames // chunks)
+    ranges = [(start, min(start + size, total_frames)) for start in range(0, total_frames, size)]
+    # The frame count in the container header is only an estimate, so the
+    # last range reads until the decoder runs out
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+def split_segment(video_path, segment, chunks):
+    # Ranges of the segment's selected frames, each a segment of its own;
+    # the last one runs to the segment's end
+    start, end, stride = segment
+    ranges = split_frame_ranges(max(count_frames(video_path, segment), 1), chunks)
+    return [
+        (start + first * stride, end if last is None else start + last * stride, stride)
+        for (first, last) in ranges
+    ]
+
+def video_properties(video_path):
+    cap = cv2.VideoCapture(video_path)
+    properties = {
+        'fps': cap.get(cv2.CAP_PROP_FPS),
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+    }
+    cap.release()
+    return properties
+
+def detect_frame_range(video_path, feature, segment, max_side=None, progress=None):
+    cap = SegmentReader(video_path, segment)
+
+    frame_objects = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame_objects.append(detect_objects(frame, feature, max_side=max_side))
+        if progress is not None:
+            progress(len(frame_objects))
+
+    cap.release()
+    return frame_objects
+
+def process_pool(workers):
+    # Imported here so cold starts that never fan out skip multiprocessing.
+    # The server already runs threads (the janitor, job workers, the
+    # detector's pool), and a forked child can inherit one of their locks
+    # held for good. So workers come from a clean forkserver process. That
+    # doesn't carry OpenCV's thread count over, so each worker sets it again.
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(method),
+        initializer=cv2.setNumThreads, initargs=(OPENCV_THREADS,)
+    )
+
+def detect_video_frames(video_path, feature, workers=1, max_side=None, progress=None, segment=WHOLE_VIDEO):
+    # Boxes for every selected frame with nothing drawn or encoded, for
+    # callers that only want the annotations
+    if workers <= 1:
+        return detect_frame_range(video_path, feature, segment, max_side, progress)
+
+    ranges = split_segment(video_path, segment, workers * CHUNKS_PER_WORKER)
+    frame_objects = []
+    with process_pool(workers) as pool:
+        futures = [pool.submit(detect_frame_range, video_path, feature, part, max_side) for part in ranges]
+        for future in futures:
+            frame_objects.extend(future.result())
+            if progress is not None:
+                progress(len(frame_objects))
+    return frame_objects
+
+def process_video_parallel(video_path, output_path, feature, workers, max_side=None, progress=None, segment=WHOLE_VIDEO):
+    cap = SegmentReader(video_path, segment)
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, cap.fps, (cap.width, cap.height))
+
+    ranges = split_segment(video_path, segment, workers * CHUNKS_PER_WORKER)
+    frame_objects = []
+
+    # Workers only return boxes; decoding again here to draw and encode
+    # keeps the output in source order and avoids shipping frames between
+    # processes. Ranges are consumed in order, so writing starts as soon as
+    # the first one is done while the rest are still being detected.
+    with process_pool(workers) as pool:
+        futures = [pool.submit(detect_frame_range, video_path, feature, part, max_side) for part in ranges]
+
+        for future in futures:
+            for objects in future.result():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                draw_objects(frame, objects)
+                with stage('encode'):
+                    out.write(frame)
+                frame_objects.append(objects)
+                if progress is not None:
+                    progress(len(frame_objects))
+
+    cap.release()
+    out.release()
+
+    return frame_objects
+
+def put_until_stopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def get_until_stopped(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def process_video_pipelined(video_path, output_path, feature, workers, max_side=None, progress=None, segment=WHOLE_VIDEO):
+    cap = SegmentReader(video_path, segment)
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, cap.fps, (cap.width, cap.height))
+
+    # reader -> frames -> detection threads -> results -> writer. OpenCV
+    # drops the GIL in read, detectMultiScale and write, so the stages run
+    # concurrently; the bounded queues stall the reader when detection
+    # falls behind instead of decoding the whole clip into memory.
+    frames = queue.Queue(PIPELINE_QUEUE_SIZE)
+    results = queue.Queue(PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+    timings = {'read': 0.0, 'detect': 0.0, 'annotate': 0.0, 'encode': 0.0}
+    timings_lock = threading.Lock()
+    frame_objects = []
+
+    def read_frames():
+        try:
+            index = 0
+            while True:
+                start = time.perf_counter()
+                ret, frame = cap.read()
+                timings['read'] += time.perf_counter() - start
+                if not ret or not put_until_stopped(frames, (index, frame), stop):
+                    break
+                index += 1
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for _ in range(workers):
+                put_until_stopped(frames, None, stop)
+
+    def detect_frames():
+        elapsed = 0.0
+        try:
+            while True:
+                item = get_until_stopped(frames, stop)
+                if item is None:
+                    break
+                index, frame = item
+
+                start = time.perf_counter()
+                objects = detect_objects(frame, feature, max_side)
+                elapsed += time.perf_counter() - start
+
+                if not put_until_stopped(results, (index, frame, objects), stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            with timings_lock:
+                timings['detect'] += elapsed
+            put_until_stopped(results, None, stop)
+
+    def write_frames():
+        # Detection threads finish out of order; hold frames back until
+        # the next one in sequence arrives
+        pending = {}
+        finished = 0
+        try:
+            while finished < workers:
+                item = get_until_stopped(results, stop)
+                if item is None:
+                    if stop.is_set():
+                        break
+                    finished += 1
+                    continue
+
+                index, frame, objects = item
+                pending[index] = (frame, objects)
+
+                while len(frame_objects) in pending:
+                    frame, objects = pending.pop(len(frame_objects))
+
+                    start = time.perf_counter()
+                    draw_objects(frame, objects)
+                    timings['annotate'] += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    with stage('encode'):
+                        out.write(frame)
+                    timings['encode'] += time.perf_counter() - start
+
+                    frame_objects.append(objects)
+                    if progress is not None:
+                        progress(len(frame_objects))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=bind(read_frames)), threading.Thread(target=bind(write_frames))]
+    threads += [threading.Thread(target=bind(detect_frames)) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    timings['wall'] = time.perf_counter() - start
+
+    cap.release()
+    out.release()
+
+    if errors:
+        raise errors[0]
+
+    return frame_objects, timings
+
+def format_stage_timings(timings, frame_count, workers):
+    frame_count = max(frame_count, 1)
+    stages = ['read', 'detect', 'annotate', 'encode']
+    parts = [f"{stage} {timings[stage]:.2f}s ({timings[stage] * 1000 / frame_count:.1f} ms/frame)" for stage in stages]
+    # Detection time is summed over its threads; compare per-thread load
+    bottleneck = max(stages, key=lambda stage: timings[stage] / (workers if stage == 'detect' else 1))
+    return f"Stage timings: {', '.join(parts)}; wall {timings['wall']:.2f}s; bottleneck: {bottleneck}."
+
+def box_iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union else 0.0
+
+class KeyframeTracker:
+    # Carries boxes from the last keyframe forward by matching each box's
+    # keyframe patch inside a window around its previous position. Tracks
+    # keep their id across keyframes when a new detection overlaps them, so
+    # ids double as unique-object counts.
+
+    def __init__(self):
+        self.tracks = []
+        self.next_id = 0
+        self.unique_counts = {}
+
+    def update(self, gray, objects):
+        tracks = []
+        matched = set()
+        for (cls, x, y, w, h) in objects:
+            x, y, w, h = int(x), int(y), int(w), int(h)
+            previous = [t for t in self.tracks if t['cls'] == cls and t['id'] not in matched]
+            best = max(previous, key=lambda t: box_iou(t['box'], (x, y, w, h)), default=None)
+
+            if best is not None and box_iou(best['box'], (x, y, w, h)) >= TRACK_MATCH_IOU:
+                track_id = best['id']
+                matched.add(track_id)
+            else:
+                track_id = self.next_id
+                self.next_id += 1
+                label = BOX_CLASSES[cls]
+                self.unique_counts[label] = self.unique_counts.get(label, 0) + 1
+
+            tracks.append({
+                'id': track_id,
+                'cls': cls,
+                'box': (x, y, w, h),
+                'template': gray[y:y+h, x:x+w].copy(),
+            })
+
+        self.tracks = tracks
+        return objects
+
+    def follow(self, gray):
+        frame_h, frame_w = gray.shape[:2]
+        rows = []
+
+        for track in self.tracks:
+            x, y, w, h = track['box']
+            mx, my = int(w * TRACK_SEARCH_MARGIN), int(h * TRACK_SEARCH_MARGIN)
+            x0, y0 = max(0, x - mx), max(0, y - my)
+            x1, y1 = min(frame_w, x + w + mx), min(frame_h, y + h + my)
+
+            window = gray[y0:y1, x0:x1]
+            if window.shape[0] < h or window.shape[1] < w:
+                return None
+
+            scores = cv2.matchTemplate(window, track['template'], cv2.TM_CCOEFF_NORMED)
+            _, score, _, (dx, dy) = cv2.minMaxLoc(scores)
+            if score < TRACK_MIN_SCORE:
+                return None
+
+            track['box'] = (x0 + dx, y0 + dy, w, h)
+            rows.append((track['cls'], x0 + dx, y0 + dy, w, h))
+
+        return make_boxes(rows)
+
+def process_video_tracked(video_path, output_path, feature, keyframe_interval, max_side=None, progress=None, segment=WHOLE_VIDEO):
+    cap = SegmentReader(video_path, segment)
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, cap.fps, (cap.width, cap.height))
+
+    tracker = KeyframeTracker()
+    frame_objects = []
+    keyframes = 0
+    since_keyframe = 0
+
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        with stage('grayscale'):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        objects = None
+        if frame_objects and since_keyframe < keyframe_interval:
+            # A lost track forces a keyframe on this frame
+            with stage('track'):
+                objects = tracker.follow(gray)
+
+        if objects is None:
+            objects = tracker.update(gray, detector.detect_gray(gray, feature, max_side))
+            keyframes += 1
+            since_keyframe = 0
+
+        since_keyframe += 1
+        draw_objects(frame, objects)
+        with stage('encode'):
+            out.write(frame)
+        frame_objects.append(objects)
+        if progress is not None:
+            progress(len(frame_objects))
+
+    cap.release()
+    out.release()
+
+    return frame_objects, {'keyframes': keyframes, 'unique_counts': tracker.unique_counts}
+
+def summarize_tracks(feature, frame_count, tracking):
+    unique_counts = tracking['unique_counts']
+    detections = [f"Processed {frame_count} frames, running detection on {tracking['keyframes']} keyframes."]
+    for label in [label for name in parse_features(feature) for label in FEATURE_CLASSES[name]]:
+        detections.append(f"Tracked {unique_counts.get(label, 0)} unique {label}(s).")
+    return detections
+
+class MotionGate:
+    # Compares each frame with the last one detection ran on, at low
+    # resolution. Unchanged frames reuse the previous boxes; changed ones
+    # are searched only around the moving pixels and the boxes they touch,
+    # keeping the boxes elsewhere. Comparing against the last detected
+    # frame rather than the previous one means slow drift still adds up to
+    # a change eventually.
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, settings):
+        self.reference = None
+        self.objects = None
+        self.settings = settings
+        self.frames = 0
+        self.skipped = 0
+        self.partial = 0
+        self.full_seconds = 0.0
+        self.full_runs = 0
+        self.partial_seconds = 0.0
+        self.gate_seconds = 0.0
+
+    def changed_region(self, gray):
+        # None when nothing moved, otherwise (x, y, w, h) in frame
+        # coordinates covering the moving pixels
+        scale = min(MOTION_SIDE / max(gray.shape[:2]), 1.0)
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+
+        reference, self.reference = self.reference, small
+        if reference is None or reference.shape != small.shape:
+            return (0, 0, gray.shape[1], gray.shape[0])
+
+        _, mask = cv2.threshold(cv2.absdiff(small, reference), MOTION_THRESHOLD, 255, cv2.THRESH_BINARY)
+        if cv2.countNonZero(mask) < MOTION_MIN_AREA * mask.size:
+            # Keep comparing against the frame the boxes came from
+            self.reference = reference
+            return None
+
+        x, y, w, h = cv2.boundingRect(mask)
+        return (int(x / scale), int(y / scale), int(np.ceil(w / scale)), int(np.ceil(h / scale)))
+
+    def detect(self, gray, feature, max_side=None):
+        if self.settings != (feature, max_side):
+            # Boxes and costs from another feature or scale do not carry over
+            self.reset((feature, max_side))
+
+        start = time.perf_counter()
+        with stage('motion'):
+            region = self.changed_region(gray)
+        self.gate_seconds += time.perf_counter() - start
+        self.frames += 1
+
+        if region is None:
+            self.skipped += 1
+            return self.objects
+
+        frame_h, frame_w = gray.shape[:2]
+        x0, y0, x1, y1 = region[0], region[1], region[0] + region[2], region[1] + region[3]
+
+        # Boxes the change touches are searched again along with it, so an
+        # object that moved is found whole at its new position
+        previous = self.objects if self.objects is not None else make_boxes([])
+        touched = ((previous['x'] < x1) & (previous['x'] + previous['w'] > x0) &
+                   (previous['y'] < y1) & (previous['y'] + previous['h'] > y0))
+        for box in previous[touched]:
+            x0, y0 = min(x0, box['x']), min(y0, box['y'])
+            x1, y1 = max(x1, box['x'] + box['w']), max(y1, box['y'] + box['h'])
+
+        margin = int(max(frame_w, frame_h) * MOTION_MARGIN)
+        x0, y0 = max(0, int(x0) - margin), max(0, int(y0) - margin)
+        x1, y1 = min(frame_w, int(x1) + margin), min(frame_h, int(y1) + margin)
+
+        start = time.perf_counter()
+        if self.objects is None or (x1 - x0) * (y1 - y0) > MOTION_FULL_FRAME * frame_w * frame_h:
+            self.objects = detector.detect_gray(gray, feature, max_side)
+            self.full_seconds += time.perf_counter() - start
+            self.full_runs += 1
+        else:
+            # Boxes the change did not reach stay as they were
+            found = detector.detect_region(gray, feature, (x0, y0, x1 - x0, y1 - y0), max_side)
+            kept = previous[(previous['x'] + previous['w'] <= x0) | (previous['x'] >= x1) |
+                            (previous['y'] + previous['h'] <= y0) | (previous['y'] >= y1)]
+            self.objects = np.concatenate([kept, found])
+            self.partial_seconds += time.perf_counter() - start
+            self.partial += 1
+        return self.objects
+
+    def stats(self):
+        # Time saved assumes every gated frame would have cost an average
+        # full-frame pass, less what the gate and partial passes cost
+        average = self.full_seconds / self.full_runs if self.full_runs else 0.0
+        saved = average * (self.skipped + self.partial) - self.partial_seconds - self.gate_seconds
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'partial': self.partial,
+            'skip_rate': round(self.skipped / self.frames, 3) if self.frames else 0.0,
+            'saved_seconds': round(saved, 3),
+        }
+
+def process_video_gated(video_path, output_path, feature, max_side=None, progress=None, segment=WHOLE_VIDEO):
+    cap = SegmentReader(video_path, segment)
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, cap.fps, (cap.width, cap.height))
+
+    gate = MotionGate()
+    frame_objects = []
+
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        with stage('grayscale'):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        objects = gate.detect(gray, feature, max_side)
+
+        draw_objects(frame, objects)
+        with stage('encode'):
+            out.write(frame)
+        frame_objects.append(objects)
+        if progress is not None:
+            progress(len(frame_objects))
+
+    cap.release()
+    out.release()
+
+    return frame_objects, gate.stats()
+
+def format_motion_stats(motion):
+    return (f"Motion gate skipped {motion['skipped']} of {motion['frames']} frames "
+            f"({motion['skip_rate']:.0%}), searched changed regions only on {motion['partial']}, "
+            f"saving about {motion['saved_seconds']:.2f}s of detection.")
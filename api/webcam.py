@@ -0,0 +1,202 @@
+import os
+import cv2
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from metrics import stage
+from detection import BOX_CLASSES, EYE, FEATURE_CLASSES, detector, make_boxes
+from video import MotionGate
+
+# Gate /detect_webcam frames on motion since the session's last detected
+# frame; clients opt in per request with motion=true either way
+WEBCAM_MOTION_GATE = os.environ.get('WEBCAM_MOTION_GATE', 'false').lower() in ('1', 'true', 'yes')
+# Search only around the session's previous boxes between full-frame scans
+WEBCAM_ROI_SEARCH = os.environ.get('WEBCAM_ROI_SEARCH', 'true').lower() in ('1', 'true', 'yes')
+# Frames between full-frame scans while every box is still being found, so
+# objects that come into view are picked up
+WEBCAM_FULL_SCAN_INTERVAL = int(os.environ.get('WEBCAM_FULL_SCAN_INTERVAL', '10'))
+# Seconds without a frame before a session's state is dropped
+WEBCAM_SESSION_TTL = int(os.environ.get('WEBCAM_SESSION_TTL', '60'))
+# Sessions kept at once; the least recently seen go first
+WEBCAM_MAX_SESSIONS = int(os.environ.get('WEBCAM_MAX_SESSIONS', '256'))
+# Round trip in milliseconds the browser aims for; it trades frame rate,
+# upload resolution and JPEG quality to stay near it
+WEBCAM_TARGET_LATENCY = int(os.environ.get('WEBCAM_TARGET_LATENCY', '250'))
+
+# Seconds since its last frame within which a session counts as a viewer
+VIEWER_WINDOW = 5
+
+# Session ids come from the client; longer ones are ignored
+MAX_SESSION_ID = 64
+
+# Search margin around each previous box, as a fraction of its size
+ROI_MARGIN = 0.5
+
+# Feature that finds each box class; eyes are found with their face
+CLASS_FEATURES = {
+    BOX_CLASSES.index(label): name
+    for name, labels in FEATURE_CLASSES.items() for label in labels if label != 'eye'
+}
+
+class RegionTracker:
+    # Searches the neighbourhood of the previous frame's boxes instead of
+    # the whole frame. Nearby boxes share one merged region, so a region
+    # never finds the same object twice. A region that comes back with
+    # fewer boxes than went into it counts as a lost track and the frame
+    # is scanned in full instead.
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, settings):
+        self.objects = None
+        self.settings = settings
+        self.since_full = 0
+        self.full_scans = 0
+        self.roi_scans = 0
+        self.lost = 0
+        self.mode = None
+
+    def search_regions(self, shape):
+        frame_h, frame_w = shape[:2]
+        regions = []
+        for box in self.objects[self.objects['cls'] != EYE]:
+            mx, my = int(box['w'] * ROI_MARGIN), int(box['h'] * ROI_MARGIN)
+            region = [
+                CLASS_FEATURES[box['cls']], 1,
+                max(0, int(box['x']) - mx), max(0, int(box['y']) - my),
+                min(frame_w, int(box['x'] + box['w']) + mx), min(frame_h, int(box['y'] + box['h']) + my),
+            ]
+
+            # Grow the region over any it overlaps until it stands alone
+            while True:
+                overlapping = [
+                    other for other in regions
+                    if other[0] == region[0] and other[2] < region[4] and region[2] < other[4]
+                    and other[3] < region[5] and region[3] < other[5]
+                ]
+                if not overlapping:
+                    break
+                for other in overlapping:
+                    regions.remove(other)
+                    region[1] += other[1]
+                    region[2:] = min(region[2], other[2]), min(region[3], other[3]), max(region[4], other[4]), max(region[5], other[5])
+            regions.append(region)
+
+        return [(name, expected, (x0, y0, x1 - x0, y1 - y0)) for name, expected, x0, y0, x1, y1 in regions]
+
+    def scan(self, gray, feature, max_side):
+        self.objects = detector.detect_gray(gray, feature, max_side)
+        self.since_full = 0
+        self.full_scans += 1
+        self.mode = 'full'
+        return self.objects
+
+    def detect(self, gray, feature, max_side=None):
+        if self.settings != (feature, max_side):
+            self.reset((feature, max_side))
+
+        self.since_full += 1
+        if self.objects is None or not (self.objects['cls'] != EYE).any() or self.since_full >= WEBCAM_FULL_SCAN_INTERVAL:
+            return self.scan(gray, feature, max_side)
+
+        found = []
+        for name, expected, region in self.search_regions(gray.shape):
+            boxes = detector.detect_region(gray, name, region, max_side)
+            if (boxes['cls'] != EYE).sum() < expected:
+                self.lost += 1
+                return self.scan(gray, feature, max_side)
+            found.append(boxes)
+
+        self.objects = np.concatenate(found) if found else make_boxes([])
+        self.roi_scans += 1
+        self.mode = 'roi'
+        return self.objects
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'full_scans': self.full_scans,
+            'roi_scans': self.roi_scans,
+            'lost_tracks': self.lost,
+        }
+
+class WebcamSession:
+    def __init__(self):
+        self.gate = MotionGate()
+        self.tracker = RegionTracker()
+        self.last_seen = time.time()
+        # A client with a request still in flight may send the next frame
+        self.lock = threading.Lock()
+
+class WebcamSessions:
+    # Per-client state for the stateless /detect_webcam endpoint, kept in
+    # memory and ordered by when each session was last seen
+
+    def __init__(self, ttl=WEBCAM_SESSION_TTL, max_sessions=WEBCAM_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.sockets = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        if not session_id or len(session_id) > MAX_SESSION_ID:
+            return None
+
+        now = time.time()
+        with self._lock:
+            while self.sessions:
+                oldest = next(iter(self.sessions.values()))
+                if now - oldest.last_seen <= self.ttl:
+                    break
+                self.sessions.popitem(last=False)
+
+            session = self.sessions.pop(session_id, None) or WebcamSession()
+            session.last_seen = now
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session
+
+    @contextmanager
+    def connected(self):
+        # Socket connections keep their own state but share the lane
+        with self._lock:
+            self.sockets += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.sockets -= 1
+
+    def viewers(self):
+        since = time.time() - VIEWER_WINDOW
+        with self._lock:
+            recent = sum(1 for session in self.sessions.values() if session.last_seen >= since)
+            return max(1, recent + self.sockets)
+
+def pacing_hints(lane, processing_seconds, viewers):
+    # With `viewers` sharing the lane's slots, each can send a frame every
+    # processing * viewers / slots seconds before a queue builds up; one
+    # already waiting means that pace is too fast, so ask for more room
+    interval = processing_seconds * viewers / lane.slots * (1 + lane.waiting)
+    return {
+        'processing_ms': round(processing_seconds * 1000, 1),
+        'target_ms': WEBCAM_TARGET_LATENCY,
+        'min_interval_ms': round(interval * 1000),
+        'viewers': viewers,
+        'queued': lane.waiting,
+    }
+
+def detect_session_frame(session, img, feature, max_side=None, motion=False):
+    # The motion gate already narrows the search to what changed, so it
+    # takes the place of the region search when asked for
+    with stage('grayscale'):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    with session.lock:
+        if motion:
+            return session.gate.detect(gray, feature, max_side), {'motion': session.gate.stats()}
+        return session.tracker.detect(gray, feature, max_side), {'search': session.tracker.stats()}
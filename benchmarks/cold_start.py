@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs in a fresh interpreter so nothing is already imported or parsed
+PROBE = r'''
+import io, sys, json, time
+start = time.perf_counter()
+import cv2
+cv2_ms = (time.perf_counter() - start) * 1000
+import flask
+flask_ms = (time.perf_counter() - start) * 1000 - cv2_ms
+sys.path.insert(0, sys.argv[1])
+before = time.perf_counter()
+module = __import__(sys.argv[2])
+module_ms = (time.perf_counter() - before) * 1000
+ready_ms = (time.perf_counter() - start) * 1000
+
+import numpy as np
+from detection import detector
+frame = cv2.imencode('.jpg', np.zeros((480, 640, 3), np.uint8))[1].tobytes()
+client = module.app.test_client()
+first = {}
+for feature in sys.argv[3].split(','):
+    begin = time.perf_counter()
+    response = client.post('/detect_webcam', data={'image': (io.BytesIO(frame), 'f.jpg'), 'feature': feature},
+                           content_type='multipart/form-data')
+    first[feature] = {'ms': (time.perf_counter() - begin) * 1000, 'status': response.status_code,
+                      'error': (response.get_json() or {}).get('error')}
+
+print(json.dumps({
+    'import_ms': {'cv2': cv2_ms, 'flask': flask_ms, sys.argv[2]: module_ms, 'total': ready_ms},
+    'first_request': first,
+    'cascade_load_ms': {name: pool.load_seconds * 1000 for name, pool in detector.pools.items() if pool.load_seconds is not None},
+}))
+'''
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start import time and first-request cost per cascade')
+    parser.add_argument('--entry', default='index', choices=['app', 'index'])
+    parser.add_argument('--features', default='face,pedestrian,vehicle')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    for run in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE, os.path.join(ROOT, 'api'), args.entry, args.features],
+            capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+
+        imports = ', '.join(f"{name} {ms:.0f}" for name, ms in result['import_ms'].items())
+        cascades = ', '.join(f"{name} {ms:.1f}" for name, ms in result['cascade_load_ms'].items())
+        print(f"run {run + 1}: import ms {imports}; cascade load ms {cascades}")
+        for feature, first in result['first_request'].items():
+            outcome = first['error'] or 'ok'
+            print(f"  first {feature} request {first['ms']:.0f} ms ({first['status']}: {outcome})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import glob
+import time
+import hashlib
+import argparse
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+import cv2
+from detection import detect_objects
+from video import box_iou
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+def load_corpus(paths, frame_step):
+    # Stills as-is, plus every `frame_step`-th frame of each clip; byte
+    # identical uploads are only counted once
+    frames, seen = [], set()
+    for path in paths:
+        digest = hashlib.sha256(open(path, 'rb').read()).hexdigest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            frames.append(cv2.imread(path))
+            continue
+
+        cap = cv2.VideoCapture(path)
+        index = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if index % frame_step == 0:
+                frames.append(frame)
+            index += 1
+        cap.release()
+    return frames
+
+def match_rate(reference, candidate, threshold=0.5):
+    total = hits = 0
+    for ref_objects, cand_objects in zip(reference, candidate):
+        for (cls, x, y, w, h) in ref_objects:
+            total += 1
+            hits += any(
+                c['cls'] == cls and box_iou((c['x'], c['y'], c['w'], c['h']), (x, y, w, h)) >= threshold
+                for c in cand_objects
+            )
+    return hits / total if total else 1.0
+
+def run(frames, feature, max_side):
+    results, latencies = [], []
+    for frame in frames:
+        start = time.perf_counter()
+        results.append(detect_objects(frame, feature, max_side=max_side))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, statistics.median(latencies)
+
+def main():
+    parser = argparse.ArgumentParser(description='Detection latency and recall per maximum detection resolution')
+    parser.add_argument('paths', nargs='*', default=sorted(glob.glob(os.path.join(ROOT, 'static', 'uploads', '*'))))
+    parser.add_argument('--features', default='face,pedestrian')
+    parser.add_argument('--sides', default='1280,960,800,640,480')
+    parser.add_argument('--frame-step', type=int, default=30)
+    args = parser.parse_args()
+
+    frames = load_corpus(args.paths, args.frame_step)
+    print(f"{len(frames)} frames")
+
+    for feature in args.features.split(','):
+        full, full_ms = run(frames, feature, 0)
+        print(f"{feature} full: {full_ms:.1f} ms median, {sum(len(objects) for objects in full)} boxes")
+
+        for max_side in [int(side) for side in args.sides.split(',')]:
+            capped, capped_ms = run(frames, feature, max_side)
+            print(f"{feature} max_side={max_side}: {capped_ms:.1f} ms median ({full_ms / capped_ms:.2f}x), "
+                  f"{sum(len(objects) for objects in capped)} boxes, recall {match_rate(full, capped):.3f}, "
+                  f"precision {match_rate(capped, full):.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+import cv2
+import numpy as np
+from detection import EYE, FACE, EYE_REGION_BOTTOM, detector, detect_objects, detection_scale
+from detection_resolution import load_corpus, match_rate
+
+def time_eye_stage(frames, eye_search, max_side, repeat):
+    # Eye pass only, on the faces the (unchanged) face pass finds
+    latencies = []
+    with detector.pools['face'].acquire() as face_cascade, detector.pools['eye'].acquire() as eye_cascade:
+        for frame in frames:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            scale = detection_scale(gray.shape, 'face', max_side)
+            if scale < 1.0:
+                gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+            for face in face_cascade.detectMultiScale(gray, 1.3, 5):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    detector.detect_eyes(eye_cascade, gray, face, eye_search)
+                latencies.append((time.perf_counter() - start) * 1000 / repeat)
+    return latencies
+
+def run(frames, eye_search, max_side):
+    results, elapsed = [], 0.0
+    for frame in frames:
+        start = time.perf_counter()
+        results.append(detect_objects(frame, 'face', max_side=max_side, eye_search=eye_search))
+        elapsed += time.perf_counter() - start
+    return results, elapsed * 1000
+
+def eyes_only(frame_objects):
+    return [objects[objects['cls'] == EYE] for objects in frame_objects]
+
+def plausible_eyes(frame_objects):
+    # Full-search eyes whose centre is in the upper part of a face; the
+    # rest are mostly nostrils and mouth corners
+    kept = []
+    for objects in frame_objects:
+        faces = objects[objects['cls'] == FACE]
+        eyes = objects[objects['cls'] == EYE]
+        cx, cy = eyes['x'] + eyes['w'] / 2, eyes['y'] + eyes['h'] / 2
+        inside = np.zeros(len(eyes), dtype=bool)
+        for (_, x, y, w, h) in faces:
+            inside |= (cx >= x) & (cx <= x + w) & (cy >= y) & (cy <= y + h * EYE_REGION_BOTTOM)
+        kept.append(eyes[inside])
+    return kept
+
+def main():
+    parser = argparse.ArgumentParser(description='Face+eye pipeline cost per face with full and constrained eye search')
+    parser.add_argument('paths', nargs='*', default=sorted(glob.glob(os.path.join(ROOT, 'static', 'uploads', '*'))))
+    parser.add_argument('--max-side', type=int, default=None)
+    parser.add_argument('--frame-step', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    frames = load_corpus(args.paths, args.frame_step)
+    full, full_ms = run(frames, 'full', args.max_side)
+    faces = sum(int((objects['cls'] == FACE).sum()) for objects in full)
+    print(f"{len(frames)} frames, {faces} faces")
+    if not faces:
+        return
+
+    full_eye_ms = statistics.median(time_eye_stage(frames, 'full', args.max_side, args.repeat))
+    print(f"full: {full_ms / faces:.2f} ms/face face+eye, eye stage {full_eye_ms:.2f} ms/face median, "
+          f"{sum(len(objects) for objects in eyes_only(full))} eyes")
+
+    constrained, constrained_ms = run(frames, 'constrained', args.max_side)
+    constrained_eye_ms = statistics.median(time_eye_stage(frames, 'constrained', args.max_side, args.repeat))
+    print(f"constrained: {constrained_ms / faces:.2f} ms/face face+eye ({full_ms / constrained_ms:.2f}x), "
+          f"eye stage {constrained_eye_ms:.2f} ms/face median ({full_eye_ms / constrained_eye_ms:.2f}x), "
+          f"{sum(len(objects) for objects in eyes_only(constrained))} eyes, "
+          f"eye recall {match_rate(eyes_only(full), eyes_only(constrained)):.3f} "
+          f"({match_rate(plausible_eyes(full), eyes_only(constrained)):.3f} of eyes in the upper face), "
+          f"precision {match_rate(eyes_only(constrained), eyes_only(full)):.3f}")
+
+if __name__ == '__main__':
+    main()
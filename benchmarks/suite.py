@@ -0,0 +1,255 @@
+import os
+import io
+import sys
+import json
+import glob
+import time
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+import cv2
+import numpy as np
+from detection import detect_objects, draw_objects
+from video import process_video_pipelined
+from detection_resolution import load_corpus
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
+STAGES = ('decode', 'detect', 'annotate', 'encode')
+
+def reset_peak_rss():
+    # Linux lets a process reset its high-water mark; elsewhere the peak
+    # is for the whole run so far
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'mean': float(np.mean(values))}
+
+def synthetic_frames(frames, resolutions):
+    # The first corpus frame resized to each resolution, so there is always
+    # something to find; a seeded noise frame when the corpus is empty
+    source = frames[0] if frames else np.random.default_rng(0).integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+    synthetic = {}
+    for resolution in resolutions:
+        width, height = (int(side) for side in resolution.split('x'))
+        synthetic[resolution] = cv2.resize(source, (width, height), interpolation=cv2.INTER_AREA)
+    return synthetic
+
+def bench_frames(name, frames, feature, repeat):
+    # Same steps as /detect with persist=false: decode the upload, detect,
+    # draw, encode the result
+    payloads = [cv2.imencode('.jpg', frame)[1].tobytes() for frame in frames]
+    stages = {stage: [] for stage in STAGES}
+    totals = []
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for payload in payloads:
+            marks = [time.perf_counter()]
+            img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+            marks.append(time.perf_counter())
+            objects = detect_objects(img, feature)
+            marks.append(time.perf_counter())
+            draw_objects(img, objects)
+            marks.append(time.perf_counter())
+            cv2.imencode('.jpg', img)
+            marks.append(time.perf_counter())
+
+            for stage, begin, end in zip(STAGES, marks, marks[1:]):
+                stages[stage].append((end - begin) * 1000)
+            totals.append((marks[-1] - marks[0]) * 1000)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'mode': 'frames',
+        'name': name,
+        'feature': feature,
+        'frames': len(totals),
+        'fps': len(totals) / elapsed,
+        'latency_ms': percentiles(totals),
+        'stages_ms': {stage: percentiles(values) for stage, values in stages.items()},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def bench_video(path, feature, workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        reset_peak_rss()
+        frame_objects, timings = process_video_pipelined(path, os.path.join(tmp, 'out.mp4'), feature, workers)
+
+    frame_count = max(len(frame_objects), 1)
+    return {
+        'mode': 'video',
+        'name': os.path.basename(path),
+        'feature': feature,
+        'frames': len(frame_objects),
+        'fps': len(frame_objects) / timings['wall'],
+        'stages_ms': {stage: timings[stage] * 1000 / frame_count for stage in ('read', 'detect', 'annotate', 'encode')},
+        'wall_s': timings['wall'],
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def bench_endpoints(stills, videos, feature, repeat, entry):
+    # Drives the real routes through the Flask test client, with a cache
+    # that keeps nothing so every request runs the detection path
+    module = __import__(entry)
+    from cache import DetectionCache
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        module.cache = DetectionCache(tmp, max_entries=0, max_bytes=0)
+        client = module.app.test_client()
+
+        requests = [
+            ('/detect', 'image', [(name, payload) for name, payload in stills]),
+            ('/detect_webcam', 'image', [(name, payload) for name, payload in stills]),
+            ('/detect_video', 'video', videos),
+        ]
+        for route, field, uploads in requests:
+            if not uploads:
+                continue
+
+            latencies = []
+            reset_peak_rss()
+            start = time.perf_counter()
+            for _ in range(1 if field == 'video' else repeat):
+                for name, payload in uploads:
+                    begin = time.perf_counter()
+                    response = client.post(route, data={field: (io.BytesIO(payload), name), 'feature': feature},
+                                           content_type='multipart/form-data')
+                    response.close()
+                    if response.status_code != 200:
+                        raise RuntimeError(f"{route} {name}: {response.status_code} {response.get_data(as_text=True)}")
+                    latencies.append((time.perf_counter() - begin) * 1000)
+            elapsed = time.perf_counter() - start
+
+            results.append({
+                'mode': 'e2e',
+                'name': f"{entry}{route}",
+                'feature': feature,
+                'requests': len(latencies),
+                'rps': len(latencies) / elapsed,
+                'latency_ms': percentiles(latencies),
+                'peak_rss_mb': peak_rss_mb(),
+            })
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'cpu_count': os.cpu_count(),
+        'platform': platform.platform(),
+        'env': {key: value for key, value in os.environ.items()
+                if key.startswith(('DETECTION_', 'VIDEO_', 'EYE_', 'BATCH_'))},
+    }
+
+def result_key(result):
+    return (result['mode'], result['name'], result['feature'])
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {result_key(result): result for result in json.load(f)['results']}
+
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None:
+            continue
+        rate = 'rps' if result['mode'] == 'e2e' else 'fps'
+        line = f"{' '.join(result_key(result))}: {rate} {old[rate]:.2f} -> {result[rate]:.2f} ({result[rate] / old[rate]:.2f}x)"
+        if 'latency_ms' in result:
+            line += f", p95 {old['latency_ms']['p95']:.1f} -> {result['latency_ms']['p95']:.1f} ms"
+        print(line)
+
+def describe(result):
+    if result['mode'] == 'e2e':
+        return (f"{result['name']} {result['feature']}: {result['rps']:.2f} req/s, "
+                f"p50/p95/p99 {result['latency_ms']['p50']:.1f}/{result['latency_ms']['p95']:.1f}/"
+                f"{result['latency_ms']['p99']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MB")
+    if result['mode'] == 'video':
+        stages = ', '.join(f"{stage} {ms:.1f}" for stage, ms in result['stages_ms'].items())
+        return (f"video {result['name']} {result['feature']}: {result['fps']:.2f} fps, "
+                f"ms/frame {stages}, peak RSS {result['peak_rss_mb']:.0f} MB")
+    stages = ', '.join(f"{stage} {values['p50']:.1f}" for stage, values in result['stages_ms'].items())
+    return (f"{result['name']} {result['feature']}: {result['fps']:.2f} fps, "
+            f"p50/p95/p99 {result['latency_ms']['p50']:.1f}/{result['latency_ms']['p95']:.1f}/"
+            f"{result['latency_ms']['p99']:.1f} ms, p50 stages {stages}, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency, throughput and memory of the detection paths over a fixed corpus')
+    parser.add_argument('paths', nargs='*', default=sorted(glob.glob(os.path.join(ROOT, 'static', 'uploads', '*'))))
+    parser.add_argument('--features', default='face,pedestrian')
+    parser.add_argument('--modes', default='frames,video,e2e')
+    parser.add_argument('--resolutions', default='640x480,1280x720,1920x1080')
+    parser.add_argument('--frame-step', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--entry', default='app', choices=['app', 'index'])
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON from an earlier run to compare against')
+    args = parser.parse_args()
+
+    modes = args.modes.split(',')
+    videos = [path for path in args.paths if path.lower().endswith(VIDEO_EXTENSIONS)]
+    corpus = load_corpus(args.paths, args.frame_step)
+    synthetic = synthetic_frames(corpus, args.resolutions.split(','))
+    print(f"{len(corpus)} corpus frames, {len(videos)} videos, synthetic {', '.join(synthetic)}")
+
+    results = []
+    for feature in args.features.split(','):
+        if 'frames' in modes:
+            if corpus:
+                results.append(bench_frames('corpus', corpus, feature, args.repeat))
+                print(describe(results[-1]))
+            for resolution, frame in synthetic.items():
+                results.append(bench_frames(f"synthetic {resolution}", [frame], feature, args.repeat))
+                print(describe(results[-1]))
+
+        if 'video' in modes:
+            for path in videos:
+                results.append(bench_video(path, feature, args.workers))
+                print(describe(results[-1]))
+
+        if 'e2e' in modes:
+            stills = [(f"{resolution}.jpg", cv2.imencode('.jpg', frame)[1].tobytes()) for resolution, frame in synthetic.items()]
+            uploads = [(os.path.basename(path), open(path, 'rb').read()) for path in videos]
+            for result in bench_endpoints(stills, uploads, feature, args.repeat, args.entry):
+                results.append(result)
+                print(describe(result))
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
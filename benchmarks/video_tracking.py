@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from video import process_video_tracked, box_iou
+
+def match_rate(reference, candidate, threshold=0.5):
+    # Fraction of boxes in `reference` that have a same-class box in
+    # `candidate` overlapping it by at least `threshold` IoU
+    total = hits = 0
+    for ref_objects, cand_objects in zip(reference, candidate):
+        for (cls, x, y, w, h) in ref_objects:
+            total += 1
+            hits += any(
+                c['cls'] == cls and box_iou((c['x'], c['y'], c['w'], c['h']), (x, y, w, h)) >= threshold
+                for c in cand_objects
+            )
+    return hits / total if total else 1.0
+
+def run(video, feature, interval):
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        frame_objects, tracking = process_video_tracked(video, os.path.join(tmp, 'out.mp4'), feature, interval)
+        return frame_objects, tracking, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Keyframe tracking against full per-frame detection')
+    parser.add_argument('video')
+    parser.add_argument('--feature', default='face')
+    parser.add_argument('--intervals', default='5,10,15')
+    args = parser.parse_args()
+
+    # An interval of 1 runs the cascades on every frame
+    full, full_tracking, full_time = run(args.video, args.feature, 1)
+    boxes = sum(len(objects) for objects in full)
+    print(f"full: {len(full)} frames in {full_time:.2f}s ({len(full) / full_time:.1f} fps), "
+          f"{boxes} boxes, unique {full_tracking['unique_counts']}")
+
+    for interval in [int(i) for i in args.intervals.split(',')]:
+        tracked, tracking, elapsed = run(args.video, args.feature, interval)
+        print(f"every {interval}: {elapsed:.2f}s ({len(tracked) / elapsed:.1f} fps, {full_time / elapsed:.2f}x), "
+              f"{tracking['keyframes']} keyframes, recall {match_rate(full, tracked):.3f}, "
+              f"precision {match_rate(tracked, full):.3f}, unique {tracking['unique_counts']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from video import process_video_parallel
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of /detect_video detection across worker counts')
+    parser.add_argument('video')
+    parser.add_argument('--feature', default='face')
+    parser.add_argument('--workers', default='1,2,4,8')
+    args = parser.parse_args()
+
+    print(f"cpu_count={os.cpu_count()}")
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            frame_objects = process_video_parallel(args.video, os.path.join(tmp, 'out.mp4'), args.feature, workers)
+            elapsed = time.perf_counter() - start
+
+        fps = len(frame_objects) / elapsed
+        baseline = baseline or fps
+        print(f"workers={workers}: {len(frame_objects)} frames in {elapsed:.2f}s, {fps:.1f} fps, {fps / baseline:.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,93 @@ let currentFeature = null;
 let webcamStream = null;
 let detectionActive = false;
 let detectionInterval = null;
+let webcamSocket = null;
+let webcamSession = null;
+// Bumped on every start, so callbacks left over from an earlier run stop
+let detectionRun = 0;
+
+const WEBCAM_SOCKET_PATH = '/ws/webcam';
+const MAX_FRAMES_IN_FLIGHT = 2;
+const SOCKET_FEATURES = ['face', 'pedestrian', 'vehicle', 'face,pedestrian,vehicle'];
+const SOCKET_CLASSES = ['face', 'eye', 'pedestrian', 'vehicle'];
+const BOX_COLORS = {
+    face: 'rgba(255, 0, 255, 0.8)',
+    eye: 'rgba(255, 255, 0, 0.8)',
+    pedestrian: 'rgba(0, 255, 255, 0.8)',
+    vehicle: 'rgba(0, 255, 0, 0.8)'
+};
+
+// Bounds the webcam pacer adapts uploads within
+const MIN_CAPTURE_INTERVAL = 50;
+const MAX_CAPTURE_INTERVAL = 2000;
+const MIN_UPLOAD_SCALE = 0.25;
+const MIN_JPEG_QUALITY = 0.5;
+const MAX_JPEG_QUALITY = 0.9;
+
+// Holds webcam round trips near the server's target latency. Over budget,
+// frames get cheaper first (JPEG quality, then resolution) and only then
+// less frequent; under budget, the frame rate comes back first. The
+// server's min_interval_ms is a floor, so several viewers share the
+// detector instead of queueing on it.
+function createPacer() {
+    return {
+        interval: 100,
+        scale: 1,
+        quality: 0.8,
+        target: 250,
+        minInterval: 0,
+        latency: null,
+        
+        update(latency, pacing) {
+            this.latency = this.latency === null ? latency : 0.7 * this.latency + 0.3 * latency;
+            if (pacing) {
+                this.target = pacing.target_ms;
+                this.minInterval = pacing.min_interval_ms;
+            }
+            
+            if (this.latency > this.target * 1.2) {
+                if (this.quality > MIN_JPEG_QUALITY) {
+                    this.quality = Math.max(MIN_JPEG_QUALITY, this.quality - 0.1);
+                } else if (this.scale > MIN_UPLOAD_SCALE) {
+                    this.scale = Math.max(MIN_UPLOAD_SCALE, this.scale * 0.8);
+                } else {
+                    this.interval = Math.min(MAX_CAPTURE_INTERVAL, this.interval * 1.5);
+                }
+            } else if (this.latency < this.target * 0.6) {
+                if (this.interval > MIN_CAPTURE_INTERVAL) {
+                    this.interval = Math.max(MIN_CAPTURE_INTERVAL, this.interval / 1.5);
+                } else if (this.scale < 1) {
+                    this.scale = Math.min(1, this.scale / 0.8);
+                } else {
+                    this.quality = Math.min(MAX_JPEG_QUALITY, this.quality + 0.05);
+                }
+            }
+        },
+        
+        // Milliseconds to wait after a reply that took `latency`
+        delay(latency) {
+            return Math.max(this.interval, this.minInterval - latency);
+        },
+        
+        // The server turned the frame away; wait as long as it asked
+        backoff(retryAfter) {
+            this.interval = Math.min(MAX_CAPTURE_INTERVAL, this.interval * 2);
+            return Math.max(retryAfter * 1000, this.interval);
+        }
+    };
+}
+
+// Draws the current video frame at the pacer's upload size and encodes it
+function captureUpload(video, canvas, captureCanvas, pacer, callback) {
+    const width = Math.max(1, Math.round(canvas.width * pacer.scale));
+    const height = Math.max(1, Math.round(canvas.height * pacer.scale));
+    if (captureCanvas.width !== width || captureCanvas.height !== height) {
+        captureCanvas.width = width;
+        captureCanvas.height = height;
+    }
+    captureCanvas.getContext('2d').drawImage(video, 0, 0, width, height);
+    captureCanvas.toBlob(callback, 'image/jpeg', pacer.quality);
+}
 
 function selectFeature(feature) {
     currentFeature = feature;
@@ -19,6 +106,9 @@ function selectFeature(feature) {
         case 'vehicle':
             titleElement.textContent = 'Vehicle Detection';
             break;
+        case 'face,pedestrian,vehicle':
+            titleElement.textContent = 'All Features';
+            break;
     }
     
     document.getElementById('imageInput').value = '';
@@ -52,6 +142,29 @@ function addWebcamLogEntry(message) {
     logContainer.scrollTop = logContainer.scrollHeight;
 }
 
+// The serverless entry point sends processed images along with the JSON
+// result as multipart/form-data, since its /cache URLs only work on the
+// instance that rendered them; videos and the local server come as plain
+// JSON with a link
+let renderUrl = null;
+
+function readRenderResponse(response) {
+    const type = response.headers.get('Content-Type') || '';
+    if (!type.startsWith('multipart/form-data')) {
+        return response.json().then(data => {
+            data.render_url = data.image_url || data.video_url;
+            return data;
+        });
+    }
+    return response.formData().then(form => {
+        const data = JSON.parse(form.get('result'));
+        if (renderUrl) URL.revokeObjectURL(renderUrl);
+        renderUrl = URL.createObjectURL(form.get('render'));
+        data.render_url = renderUrl;
+        return data;
+    });
+}
+
 function handleImageUpload(event) {
     if (!event.target.files.length) return;
     
@@ -80,13 +193,13 @@ function handleImageUpload(event) {
                 if (!response.ok) {
                     throw new Error('Network response was not ok');
                 }
-                return response.json();
+                return readRenderResponse(response);
             })
             .then(data => {
                 document.getElementById('loadingIndicator').classList.add('hidden');
                 
                 const resultView = document.getElementById('resultView');
-                resultView.innerHTML = `<img src="${data.image_data || data.image_url}" alt="Processed Image">`;
+                resultView.innerHTML = `<img src="${data.render_url}" alt="Processed Image">`;
                 
                 data.detections.forEach(detection => {
                     addLogEntry(detection);
@@ -128,13 +241,13 @@ function handleVideoUpload(event) {
         if (!response.ok) {
             throw new Error('Network response was not ok');
         }
-        return response.json();
+        return readRenderResponse(response);
     })
     .then(data => {
         document.getElementById('loadingIndicator').classList.add('hidden');
         
         const resultView = document.getElementById('resultView');
-        resultView.innerHTML = `<video src="${data.video_data || data.video_url}" controls></video>`;
+        resultView.innerHTML = `<video src="${data.render_url}" controls></video>`;
         
         data.detections.forEach(detection => {
             addLogEntry(detection);
@@ -182,6 +295,7 @@ function toggleDetection() {
     
     if (!detectionActive) {
         detectionActive = true;
+        const run = ++detectionRun;
         button.textContent = 'Stop Detection';
         
         const video = document.getElementById('webcam');
@@ -193,43 +307,65 @@ function toggleDetection() {
         
         addWebcamLogEntry('Starting detection...');
         
+        // Lets the server compare each HTTP frame with the previous one
+        webcamSession = window.crypto && crypto.randomUUID ? crypto.randomUUID() : Math.random().toString(36).slice(2);
+        
+        // Frames are uploaded from their own canvas, scaled down when the
+        // server is slow, and boxes are scaled back up to the display
+        const captureCanvas = document.createElement('canvas');
+        const pacer = createPacer();
+        let lastSummary = '';
+        
         function captureFrame() {
-            if (!detectionActive) return;
+            if (!detectionActive || run !== detectionRun) return;
             
-            ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
-            
-            canvas.toBlob(function(blob) {
+            const sent = performance.now();
+            captureUpload(video, canvas, captureCanvas, pacer, function(blob) {
+                const scaleX = canvas.width / captureCanvas.width;
+                const scaleY = canvas.height / captureCanvas.height;
                 const formData = new FormData();
                 formData.append('image', blob, 'webcam-frame.jpg');
                 formData.append('feature', currentFeature || 'face');
+                formData.append('session', webcamSession);
                 
                 fetch('/detect_webcam', {
                     method: 'POST',
                     body: formData
                 })
-                .then(response => response.json())
+                .then(response => {
+                    if (response.status === 429) {
+                        const wait = pacer.backoff(parseFloat(response.headers.get('Retry-After')) || 1);
+                        if (detectionActive) {
+                            setTimeout(captureFrame, wait);
+                        }
+                        return null;
+                    }
+                    return response.json();
+                })
                 .then(data => {
+                    if (!data) return;
+                    
+                    const latency = performance.now() - sent;
+                    pacer.update(latency, data.pacing);
+                    
                     ctx.clearRect(0, 0, canvas.width, canvas.height);
                     ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
                     
                     ctx.lineWidth = 3;
                     
-                    if (data.detections && data.detections.length > 0) {
-                        data.boxes.forEach((box, index) => {
-                            ctx.strokeStyle = data.colors[index] || 'rgba(255, 0, 255, 0.8)';
-                            ctx.strokeRect(box.x, box.y, box.width, box.height);
-                        });
-                        
-                        if (data.detections.length > 0 && data.detections[0] !== '') {
-                            addWebcamLogEntry(data.detections[0]);
-                        }
-                        if (data.detections.length > 0 && data.detections[0] !== '') {
-                            addWebcamLogEntry(data.detections[0]);
-                        }
+                    (data.boxes || []).forEach((box, index) => {
+                        ctx.strokeStyle = data.colors[index] || 'rgba(255, 0, 255, 0.8)';
+                        ctx.strokeRect(box.x * scaleX, box.y * scaleY, box.width * scaleX, box.height * scaleY);
+                    });
+                    
+                    const summary = data.detections && data.detections.length > 0 ? data.detections[0] : '';
+                    if (summary && summary !== lastSummary) {
+                        addWebcamLogEntry(summary);
                     }
+                    lastSummary = summary;
                     
                     if (detectionActive) {
-                        setTimeout(captureFrame, 100); 
+                        setTimeout(captureFrame, pacer.delay(latency));
                     }
                 })
                 .catch(error => {
@@ -240,17 +376,176 @@ function toggleDetection() {
                         setTimeout(captureFrame, 500); 
                     }
                 });
-            }, 'image/jpeg');
+            });
         }
         
-        captureFrame();
+        if ('WebSocket' in window) {
+            startSocketDetection(video, canvas, ctx, captureFrame);
+        } else {
+            captureFrame();
+        }
     } else {
         detectionActive = false;
         button.textContent = 'Start Detection';
         addWebcamLogEntry('Detection stopped.');
         
+        if (webcamSocket) {
+            webcamSocket.close();
+            webcamSocket = null;
+        }
+        
         const canvas = document.getElementById('webcam-canvas');
         const ctx = canvas.getContext('2d');
         ctx.clearRect(0, 0, canvas.width, canvas.height);
     }
 }
+
+function startSocketDetection(video, canvas, ctx, fallback) {
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${protocol}//${window.location.host}${WEBCAM_SOCKET_PATH}`);
+    socket.binaryType = 'arraybuffer';
+    webcamSocket = socket;
+    
+    // Frames are captured on a separate canvas so the overlay can keep
+    // showing boxes while the next frame is on its way to the server.
+    // The frames in flight hold the rate to what the server keeps up with;
+    // the pacer trades resolution and quality against the measured round
+    // trip, and the server's pacing messages space frames out further.
+    const captureCanvas = document.createElement('canvas');
+    const pacer = createPacer();
+    const pending = {};
+    
+    let opened = false;
+    let capturing = false;
+    let framesInFlight = 0;
+    let nextSeq = 0;
+    let lastSeq = -1;
+    let lastSummary = '';
+    let pausedUntil = 0;
+    let lastError = null;
+    let lastSentAt = 0;
+    let gapTimer = null;
+    
+    function sendFrames() {
+        if (!detectionActive || socket.readyState !== WebSocket.OPEN) return;
+        if (capturing || framesInFlight >= MAX_FRAMES_IN_FLIGHT) return;
+        if (performance.now() < pausedUntil) return;
+        
+        // The server's min_interval_ms spaces frames out when the lane is
+        // shared with other viewers
+        const gap = pacer.minInterval - (performance.now() - lastSentAt);
+        if (gap > 0) {
+            if (!gapTimer) {
+                gapTimer = setTimeout(function() {
+                    gapTimer = null;
+                    sendFrames();
+                }, gap);
+            }
+            return;
+        }
+        lastSentAt = performance.now();
+        
+        capturing = true;
+        const sent = performance.now();
+        captureUpload(video, canvas, captureCanvas, pacer, function(blob) {
+            capturing = false;
+            if (!blob || socket.readyState !== WebSocket.OPEN) return;
+            
+            const seq = nextSeq++;
+            const header = new DataView(new ArrayBuffer(5));
+            header.setUint32(0, seq, true);
+            header.setUint8(4, Math.max(0, SOCKET_FEATURES.indexOf(currentFeature || 'face')));
+            pending[seq] = {
+                sent: sent,
+                scaleX: canvas.width / captureCanvas.width,
+                scaleY: canvas.height / captureCanvas.height
+            };
+            
+            socket.send(new Blob([header.buffer, blob]));
+            framesInFlight++;
+            sendFrames();
+        });
+    }
+    
+    socket.onopen = function() {
+        opened = true;
+        addWebcamLogEntry('Streaming frames over WebSocket.');
+        sendFrames();
+    };
+    
+    socket.onmessage = function(event) {
+        const message = typeof event.data === 'string' ? JSON.parse(event.data) : null;
+        
+        // Pacing hints arrive on their own, not in reply to a frame
+        if (message && message.pacing) {
+            pacer.target = message.pacing.target_ms;
+            pacer.minInterval = message.pacing.min_interval_ms;
+            return;
+        }
+        
+        framesInFlight = Math.max(0, framesInFlight - 1);
+        
+        // Other text messages answer a frame the server was too busy for,
+        // or one that failed
+        if (message) {
+            delete pending[message.seq];
+            if (message.retry_after) {
+                const wait = pacer.backoff(message.retry_after);
+                pausedUntil = performance.now() + wait;
+                setTimeout(sendFrames, wait);
+            } else {
+                if (message.error !== lastError) {
+                    addWebcamLogEntry(`Error: ${message.error}`);
+                }
+                lastError = message.error;
+                sendFrames();
+            }
+            return;
+        }
+        
+        const seq = new DataView(event.data).getUint32(0, true);
+        const frame = pending[seq] || { sent: performance.now(), scaleX: 1, scaleY: 1 };
+        delete pending[seq];
+        pacer.update(performance.now() - frame.sent, null);
+        
+        if (seq > lastSeq) {
+            lastSeq = seq;
+            
+            const rows = new Int16Array(event.data, 4);
+            const counts = {};
+            
+            ctx.clearRect(0, 0, canvas.width, canvas.height);
+            ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+            ctx.lineWidth = 3;
+            
+            for (let i = 0; i + 4 < rows.length; i += 5) {
+                const label = SOCKET_CLASSES[rows[i]];
+                counts[label] = (counts[label] || 0) + 1;
+                ctx.strokeStyle = BOX_COLORS[label] || 'rgba(255, 0, 255, 0.8)';
+                ctx.strokeRect(rows[i + 1] * frame.scaleX, rows[i + 2] * frame.scaleY, rows[i + 3] * frame.scaleX, rows[i + 4] * frame.scaleY);
+            }
+            
+            const summary = Object.keys(counts).map(label => `${counts[label]} ${label}(s)`).join(', ');
+            if (summary && summary !== lastSummary) {
+                addWebcamLogEntry(`Detected ${summary}.`);
+            }
+            lastSummary = summary;
+        }
+        
+        sendFrames();
+    };
+    
+    socket.onclose = function() {
+        // A socket from a run that was stopped, even if detection has been
+        // started again since, has nothing to fall back for
+        if (webcamSocket !== socket) return;
+        webcamSocket = null;
+        
+        // The serverless deployment has no socket endpoint; fall back to
+        // one POST per frame if the connection fails or drops.
+        if (detectionActive) {
+            addWebcamLogEntry(opened ? 'WebSocket closed, sending frames over HTTP.' : 'WebSocket unavailable, sending frames over HTTP.');
+            fallback();
+        }
+    };
+}